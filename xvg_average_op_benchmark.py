@@ -0,0 +1,346 @@
+#generic python modules
+import argparse
+import sys, os, shutil
+import os.path
+import json
+import time
+import hashlib
+import subprocess
+
+##########################################################################################
+# RETRIEVE USER INPUTS
+##########################################################################################
+
+#=========================================================================================
+# create parser
+#=========================================================================================
+version_nb = "0.0.1"
+parser = argparse.ArgumentParser(prog = 'xvg_average_op_benchmark', usage='', add_help = False, formatter_class = argparse.RawDescriptionHelpFormatter, description =\
+'''
+**********************************************
+v''' + version_nb + '''
+author: Jean Helie (jean.helie@bioch.ox.ac.uk)
+git: https://github.com/jhelie/xvg_average_op
+**********************************************
+
+[ DESCRIPTION ]
+
+This script measures the throughput and memory of the averaging scripts and checks them
+against a baseline, so that a change which makes them slower, more memory hungry or
+changes their results is spotted.
+
+For each combination of nb of files, nb of rows and nan density a synthetic ensemble is
+generated (in --tmp, where it's kept for the next runs). The files have the columns of
+membrane SMa, each row of each file being empty ('nan' avg and std, nb of 0) with the
+probability given by the nan density. The data only depends on the nb of files, rows and
+the nan density, so the results of the scripts can be compared from one run to the next.
+
+Each variant ('op', 'complex' and 'simple', i.e. xvg_average_op.py etc, found in the
+same directory as this script) is then run on each ensemble --repeats times, as a
+separate process (with --no-cache and the --options given), and the following are
+recorded for the fastest run:
+ -the wall time, files/s and rows/s (rows of all the files)
+ -the peak memory (max resident set size) of the process
+ -a checksum of the averaged data written
+
+With --record these are stored in the --baseline json file (one entry per variant,
+ensemble and --options). Otherwise they are compared to it: the run fails (exit code 1)
+if the throughput is more than --tolerance (relative) below that of the baseline, if the
+peak memory is more than --mem_tolerance above it, or if the averaged data is different.
+The configurations missing from the baseline are only reported, but the run also fails
+if none of them could be compared.
+Timings are only comparable on the same machine, with the same load.
+
+Everything runs offline: only numpy and the scripts benchmarked are needed. The file
+lists are given to the scripts with --file_list, so that large ensembles don't exceed
+the max length of a command line.
+
+[ USAGE ]
+
+Option	      Default  	Description
+-----------------------------------------------------
+--files		10,100,1000
+			: nb of files of the ensembles (comma separated)
+--rows		100,1000: nb of rows of the files (comma separated)
+--nan		0,0.5,0.9
+			: nan densities of the files (comma separated)
+--variants	op,complex,simple
+			: scripts to benchmark
+--options		: options passed to the scripts (e.g. --options='--mmap --sparse')
+--repeats	1	: nb of runs of each script on each ensemble (the fastest is kept)
+--baseline	xvg_average_op_benchmark.json
+			: json file where the baseline is stored
+--record		: store the results as baseline instead of checking them
+--tolerance	0.2	: max relative decrease in throughput
+--mem_tolerance	0.2	: max relative increase in peak memory
+--tmp		/tmp/xvg_average_op_benchmark
+			: directory where the ensembles are generated
+--seed		1	: seed of the random data
+
+Other options
+-----------------------------------------------------
+--version		: show version number and exit
+-h, --help		: show this menu and exit
+
+''')
+
+#options
+parser.add_argument('--files', nargs=1, dest='files', default=['10,100,1000'], help=argparse.SUPPRESS)
+parser.add_argument('--rows', nargs=1, dest='rows', default=['100,1000'], help=argparse.SUPPRESS)
+parser.add_argument('--nan', nargs=1, dest='nan', default=['0,0.5,0.9'], help=argparse.SUPPRESS)
+parser.add_argument('--variants', nargs=1, dest='variants', default=['op,complex,simple'], help=argparse.SUPPRESS)
+parser.add_argument('--options', nargs=1, dest='options', default=[''], help=argparse.SUPPRESS)
+parser.add_argument('--repeats', nargs=1, dest='repeats', default=[1], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--baseline', nargs=1, dest='baseline', default=['xvg_average_op_benchmark.json'], help=argparse.SUPPRESS)
+parser.add_argument('--record', dest='record', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--tolerance', nargs=1, dest='tolerance', default=[0.2], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--mem_tolerance', nargs=1, dest='mem_tolerance', default=[0.2], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--tmp', nargs=1, dest='tmp', default=['/tmp/xvg_average_op_benchmark'], help=argparse.SUPPRESS)
+parser.add_argument('--seed', nargs=1, dest='seed', default=[1], type=int, help=argparse.SUPPRESS)
+
+#other options
+parser.add_argument('--version', action='version', version='%(prog)s v' + version_nb, help=argparse.SUPPRESS)
+parser.add_argument('-h','--help', action='help', help=argparse.SUPPRESS)
+
+#=========================================================================================
+# store inputs
+#=========================================================================================
+
+args = parser.parse_args()
+args.variants = args.variants[0].split(',')
+args.options = args.options[0].split()
+args.repeats = args.repeats[0]
+args.baseline = args.baseline[0]
+args.tolerance = args.tolerance[0]
+args.mem_tolerance = args.mem_tolerance[0]
+args.tmp = os.path.abspath(args.tmp[0])
+args.seed = args.seed[0]
+
+#=========================================================================================
+# import modules (doing it now otherwise might crash before we can display the help menu!)
+#=========================================================================================
+
+#generic science modules
+try:
+	import numpy as np
+except:
+	print "Error: you need to install the np module."
+	sys.exit(1)
+
+#=======================================================================
+# sanity check
+#=======================================================================
+
+try:
+	args.files = [int(n) for n in args.files[0].split(',')]
+	args.rows = [int(n) for n in args.rows[0].split(',')]
+	args.nan = [float(d) for d in args.nan[0].split(',')]
+except ValueError:
+	print "Error: --files, --rows and --nan should be comma separated numbers."
+	sys.exit(1)
+
+if min(args.files) < 2 or min(args.rows) < 1:
+	print "Error: the ensembles should have at least 2 files and 1 row."
+	sys.exit(1)
+
+if min(args.nan) < 0 or max(args.nan) > 1:
+	print "Error: --nan densities should be between 0 and 1."
+	sys.exit(1)
+
+if args.repeats < 1:
+	print "Error: --repeats should be at least 1."
+	sys.exit(1)
+
+#scripts benchmarked
+scripts = {}
+scripts["op"] = "xvg_average_op.py"
+scripts["complex"] = "xvg_average_op_complex.py"
+scripts["simple"] = "xvg_average_op_simple.py"
+for variant in args.variants:
+	if variant not in scripts:
+		print "Error: unknown variant " + str(variant) + " (should be 'op', 'complex' or 'simple')."
+		sys.exit(1)
+	scripts[variant] = os.path.join(os.path.dirname(os.path.abspath(__file__)), scripts[variant])
+
+if not args.record and not os.path.isfile(args.baseline):
+	print "Error: baseline " + str(args.baseline) + " not found (use --record to create it)."
+	sys.exit(1)
+
+##########################################################################################
+# FUNCTIONS DEFINITIONS
+##########################################################################################
+
+#=========================================================================================
+# data generation
+#=========================================================================================
+
+def generate_ensemble(nb_files, nb_rows, nan_density):
+
+	#files of membrane SMa: distance, then the upper avg, std and nb in columns 16, 20 and
+	#24 and the lower ones in columns 4, 8 and 12 (other columns being filled as well)
+	tmp_dir = os.path.join(args.tmp, "files" + str(nb_files) + "_rows" + str(nb_rows) + "_nan" + str(nan_density) + "_seed" + str(args.seed))
+	tmp_list = os.path.join(tmp_dir, "file_list.txt")
+	if os.path.isfile(tmp_list):
+		return tmp_list
+
+	if os.path.isdir(tmp_dir):
+		shutil.rmtree(tmp_dir)
+	os.makedirs(tmp_dir)
+	tmp_random = np.random.RandomState(args.seed)
+	tmp_filenames = []
+	for f_index in range(0, nb_files):
+		#display progress
+		progress = '\r -generating file ' + str(f_index+1) + '/' + str(nb_files) + '                      '
+		sys.stdout.flush()
+		sys.stdout.write(progress)
+
+		tmp_data = np.zeros((nb_rows, 25))
+		tmp_data[:,0] = np.arange(nb_rows) * 0.5
+		tmp_data[:,1:] = tmp_random.uniform(-0.5, 1, (nb_rows, 24))
+		for tmp_nb_col in [9, 12, 18, 21, 24]:
+			tmp_data[:,tmp_nb_col] = tmp_random.randint(1, 50, nb_rows)
+		tmp_empty = tmp_random.uniform(0, 1, nb_rows) < nan_density
+		tmp_data[tmp_empty, 1:] = np.nan
+		for tmp_nb_col in [9, 12, 18, 21, 24]:
+			tmp_data[tmp_empty, tmp_nb_col] = 0
+
+		filename = os.path.join(tmp_dir, "file" + str(f_index) + ".xvg")
+		with open(filename, 'w') as f:
+			f.write("# [synthetic order parameter xvg - written by xvg_average_op_benchmark v" + str(version_nb) + "]\n")
+			f.write("# -> weight = " + str(1 + f_index % 3) + "\n")
+			f.write("@ title \"Synthetic xvg\"\n")
+			np.savetxt(f, tmp_data, fmt = "%.6e", delimiter = "	")
+		tmp_filenames.append(filename)
+
+	#the list of files is written last: the ensemble is only reused if it's complete
+	with open(tmp_list + ".tmp", 'w') as f:
+		f.write("\n".join(tmp_filenames) + "\n")
+	os.rename(tmp_list + ".tmp", tmp_list)
+	sys.stdout.write("\n")
+
+	return tmp_list
+
+#=========================================================================================
+# benchmark
+#=========================================================================================
+
+def checksum_xvg(filename):
+
+	#checksum of the data lines only (the header holds the names of the files)
+	tmp_sha1 = hashlib.sha1()
+	with open(filename) as f:
+		for line in f:
+			if line[0] not in "#@":
+				tmp_sha1.update(line)
+
+	return tmp_sha1.hexdigest()
+
+def run_script(variant, tmp_list, tmp_output):
+
+	#run the script as a separate process, its peak memory being given by the resource
+	#usage of the child (ru_maxrss, in kB on Linux)
+	with open(os.devnull, 'w') as devnull:
+		tmp_start = time.time()
+		tmp_process = subprocess.Popen([sys.executable, scripts[variant], "--file_list", tmp_list, "-o", tmp_output, "--membrane", "SMa", "--no-cache"] + args.options, stdout = devnull, stderr = devnull, cwd = args.tmp)
+		tmp_pid, tmp_status, tmp_rusage = os.wait4(tmp_process.pid, 0)
+		tmp_time = time.time() - tmp_start
+	if tmp_status != 0:
+		print "\nError: " + str(scripts[variant]) + " failed on " + str(tmp_list) + " (run it with the same options to see why)."
+		sys.exit(1)
+
+	return tmp_time, tmp_rusage.ru_maxrss
+
+def benchmark():
+
+	global results
+	results = {}
+	for nb_files in args.files:
+		for nb_rows in args.rows:
+			for nan_density in args.nan:
+				tmp_list = generate_ensemble(nb_files, nb_rows, nan_density)
+				for variant in args.variants:
+					tmp_key = variant + " files=" + str(nb_files) + " rows=" + str(nb_rows) + " nan=" + str(nan_density) + " options=" + " ".join(args.options)
+					tmp_output = "benchmark_" + variant
+					tmp_times = []
+					tmp_memory = []
+					for r in range(0, args.repeats):
+						tmp_time, tmp_maxrss = run_script(variant, tmp_list, tmp_output)
+						tmp_times.append(tmp_time)
+						tmp_memory.append(tmp_maxrss)
+					tmp_result = {}
+					tmp_result["time (s)"] = min(tmp_times)
+					tmp_result["files/s"] = nb_files / max(min(tmp_times), 1e-6)
+					tmp_result["rows/s"] = nb_files * nb_rows / max(min(tmp_times), 1e-6)
+					tmp_result["peak memory (kB)"] = min(tmp_memory)
+					tmp_result["checksum"] = checksum_xvg(os.path.join(args.tmp, tmp_output + ".xvg"))
+					results[tmp_key] = tmp_result
+					print " " + tmp_key.ljust(60) + "{:10.3f} s {:12.1f} files/s {:14.1f} rows/s {:10d} kB".format(tmp_result["time (s)"], tmp_result["files/s"], tmp_result["rows/s"], tmp_result["peak memory (kB)"])
+
+	return
+
+def check_baseline():
+
+	global regressions
+	global nb_checked
+	regressions = []
+	nb_checked = 0
+	with open(args.baseline) as f:
+		baseline = json.load(f)
+	for tmp_key in sorted(results):
+		if tmp_key not in baseline:
+			print "\nWarning: no baseline for " + str(tmp_key) + " (use --record to add it)."
+			continue
+		nb_checked += 1
+		tmp_result = results[tmp_key]
+		tmp_baseline = baseline[tmp_key]
+		if tmp_result["rows/s"] < (1 - args.tolerance) * tmp_baseline["rows/s"]:
+			regressions.append(tmp_key + ": throughput of " + "{:.1f}".format(tmp_result["rows/s"]) + " rows/s, baseline " + "{:.1f}".format(tmp_baseline["rows/s"]) + " rows/s")
+		if tmp_result["peak memory (kB)"] > (1 + args.mem_tolerance) * tmp_baseline["peak memory (kB)"]:
+			regressions.append(tmp_key + ": peak memory of " + str(tmp_result["peak memory (kB)"]) + " kB, baseline " + str(tmp_baseline["peak memory (kB)"]) + " kB")
+		if tmp_result["checksum"] != tmp_baseline["checksum"]:
+			regressions.append(tmp_key + ": averaged data different than that of the baseline")
+
+	return
+
+def record_baseline():
+
+	#results of other ensembles or options already in the baseline are kept
+	baseline = {}
+	if os.path.isfile(args.baseline):
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	baseline.update(results)
+	with open(args.baseline, 'w') as f:
+		json.dump(baseline, f, indent = 1, sort_keys = True)
+
+	return
+
+##########################################################################################
+# MAIN
+##########################################################################################
+
+if not os.path.isdir(args.tmp):
+	os.makedirs(args.tmp)
+
+print "\nRunning benchmarks..."
+benchmark()
+
+if args.record:
+	record_baseline()
+	print "\nFinished successfully! Baseline recorded in file '" + args.baseline + "'."
+else:
+	check_baseline()
+	print "\n" + str(nb_checked) + " of the " + str(len(results)) + " configurations benchmarked compared to the baseline."
+	if nb_checked == 0:
+		print "\nError: none of the configurations benchmarked is in " + str(args.baseline) + " (use --record to add them)."
+		print ""
+		sys.exit(1)
+	if len(regressions) > 0:
+		print "\nRegressions found:"
+		for regression in regressions:
+			print " -" + regression
+		print ""
+		sys.exit(1)
+	print "\nFinished successfully! No regression compared to file '" + args.baseline + "'."
+print ""
+sys.exit(0)
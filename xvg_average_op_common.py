@@ -0,0 +1,719 @@
+#code shared by the xvg_average_op scripts (imported from the directory of the scripts)
+
+#generic python modules
+import sys, os, shutil
+import os.path
+import ConfigParser
+import operator
+import collections
+import functools
+import threading
+import mmap
+import json
+import hashlib
+import tempfile
+import time
+import re
+from multiprocessing.pool import ThreadPool
+
+#generic science modules
+import numpy as np
+
+#=========================================================================================
+# column layouts
+#=========================================================================================
+
+#layouts of the membranes shipped with the scripts
+layouts_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xvg_average_op_layouts.ini")
+
+def read_layouts(filename, layout_series, layouts):
+
+	#add the layouts of an ini file (one section per membrane, one 'series = column' line
+	#per series) to layouts, errors being raised as ValueError with the message to show
+	if not os.path.isfile(filename):
+		raise ValueError("file " + str(filename) + " not found.")
+	tmp_config = ConfigParser.RawConfigParser()
+	try:
+		tmp_config.read(filename)
+	except ConfigParser.MissingSectionHeaderError:
+		raise ValueError("file " + str(filename) + " should start with the name of a membrane as a section header (e.g. '[POPC]').")
+	except ConfigParser.Error, e:
+		raise ValueError("file " + str(filename) + " isn't a valid layouts file (" + " ".join(str(e).split()) + ").")
+	for tmp_name in tmp_config.sections():
+		layouts[tmp_name] = {}
+		for tmp_series, tmp_col in tmp_config.items(tmp_name):
+			try:
+				layouts[tmp_name][tmp_series] = int(tmp_col)
+			except ValueError:
+				raise ValueError("the column of '" + str(tmp_series) + "' for membrane " + str(tmp_name) + " in " + str(filename) + " should be an integer.")
+		for series in layout_series:
+			if series not in layouts[tmp_name]:
+				raise ValueError("the column of '" + str(series) + "' for membrane " + str(tmp_name) + " isn't specified in " + str(filename) + ".")
+
+	return layouts
+
+#=========================================================================================
+# data loading
+#=========================================================================================
+
+#the functions taking args use the options of the command line, which the scripts share
+
+def read_file(filename):
+	
+	with open(filename) as f:
+		content = f.read()
+	
+	return content
+
+def map_file(filename):
+	
+	#memory map of the file (an empty file can't be mapped)
+	with open(filename, 'rb') as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return ""
+		content = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+	
+	return content
+
+def read_xvg(args, indexed, filename):
+	
+	#read the file (or map it with --mmap) in a thread of the pool and, unless the files
+	#were indexed beforehand, scan it in the same thread so that it's only read once
+	if args.mmap:
+		content = map_file(filename)
+	else:
+		content = read_file(filename)
+	if indexed:
+		return content, None
+	tmp_entry = scan_xvg(args, content, filename)
+	tmp_entry["size"] = len(content)
+	
+	return content, tmp_entry
+
+def read_block(tmp_block):
+	
+	#read the bytes of a frame (filename, offset and length found when indexing)
+	filename, tmp_offset, tmp_length = tmp_block
+	with open(filename, 'rb') as f:
+		f.seek(tmp_offset)
+		content = f.read(tmp_length)
+	
+	return content
+
+def parse_block(content, filename, tmp_rows, tmp_cols, usecols):
+	
+	#parse a block of data rows with numpy, which stops at the first invalid number
+	tmp_values = np.fromstring(content, sep = " ")
+	if len(tmp_values) != tmp_rows * tmp_cols:
+		print "\nError: " + str(len(tmp_values)) + " numbers could be read from file " + str(filename) + " instead of " + str(tmp_rows) + "x" + str(tmp_cols) + " (is there a comment line after the data starts?)."
+		sys.exit(1)
+	
+	return tmp_values.reshape((tmp_rows, tmp_cols))[:, usecols]
+
+def mmap_xvg(content, filename, tmp_entry, usecols):
+	
+	#parse the data block (from the offset found when indexing) straight from the mapped
+	#file: no string is created, neither for the file nor for its lines
+	tmp_data = parse_block(buffer(content, tmp_entry["offset"]), filename, tmp_entry["rows"], tmp_entry["cols"], usecols)
+	if len(content) > 0:
+		content.close()
+	
+	return tmp_data
+
+def prefetch_xvg(args, read_function, items, item_size):
+	
+	#read the items (files or frames) in a pool of threads while the previous ones are
+	#parsed, the items being yielded in order: an item is only read if the items read
+	#ahead and not parsed yet (those being read included) would then total at most
+	#args.prefetch MB, or if there's none (so that a bigger item is read on its own)
+	buffer_size = args.prefetch * 1048576
+	buffer_sizes = collections.deque()
+	buffer_space = threading.Condition()
+	reading_stopped = threading.Event()
+	def items_to_read():
+		for item in items:
+			tmp_size = item_size(item)
+			with buffer_space:
+				while len(buffer_sizes) > 0 and sum(buffer_sizes) + tmp_size > buffer_size and not reading_stopped.is_set():
+					buffer_space.wait()
+				if reading_stopped.is_set():
+					return
+				buffer_sizes.append(tmp_size)
+			yield item
+	
+	pool = ThreadPool(args.threads)
+	try:
+		for content in pool.imap(read_function, items_to_read()):
+			yield content
+			with buffer_space:
+				buffer_sizes.popleft()
+				buffer_space.notify()
+	finally:
+		#if the reading is stopped early (generator closed), unblock the thread feeding
+		#the pool so that it can be closed
+		with buffer_space:
+			reading_stopped.set()
+			buffer_space.notify()
+		pool.close()
+	
+	return
+
+def xvg_regexes(comments):
+	
+	#comment lines (anywhere in the file) and block of comment lines at the top of the file
+	#(compiled once for each list of comment characters)
+	comments = tuple(comments)
+	if comments not in xvg_regexes_compiled:
+		tmp_comments_chars = re.escape("".join([c for c in comments if len(c) == 1]))
+		tmp_regexes = {}
+		tmp_regexes["comments"] = re.compile("^[" + tmp_comments_chars + "].*$", re.M)
+		tmp_regexes["header"] = re.compile("(?:[" + tmp_comments_chars + "][^\n]*(?:\n|$))*")
+		tmp_regexes["blank"] = re.compile("^[ \t\r]*$", re.M)
+		tmp_regexes["data"] = re.compile("^[ \t]*\S.*$", re.M)
+		tmp_regexes["legend"] = re.compile("^@\s*s(\d+)\s+legend\s+\"(.*)\"")
+		tmp_regexes["frame"] = re.compile("(?:^[ \t]*[^\s&" + tmp_comments_chars + "][^\n]*(?:\n|$))+", re.M)
+		xvg_regexes_compiled[comments] = tmp_regexes
+	
+	return xvg_regexes_compiled[comments]
+
+xvg_regexes_compiled = {}
+
+def scan_xvg(args, content, filename):
+
+	#find the comment lines with regexes on the content (or memory map) of the file: no
+	#number is parsed and no string is created for the data lines
+	tmp_regexes = xvg_regexes(args.comments)
+	tmp_comments = tmp_regexes["comments"].findall(content)
+	tmp_entry = {}
+	tmp_entry["weight"] = 1
+	tmp_entry["header"] = len(tmp_comments)
+	tmp_entry["offset"] = tmp_regexes["header"].match(content).end()
+
+	#count data rows and columns (lines being counted by chunks of the map)
+	tmp_nb_lines = 0
+	for tmp_start in range(0, len(content), 1 << 24):
+		tmp_nb_lines += content[tmp_start:tmp_start + (1 << 24)].count("\n")
+	tmp_nb_blank = len(tmp_regexes["blank"].findall(content))
+	if content[-1:] == "\n" or len(content) == 0:
+		tmp_nb_blank -= 1
+	else:
+		tmp_nb_lines += 1
+	tmp_entry["rows"] = tmp_nb_lines - tmp_nb_blank - len(tmp_comments)
+	tmp_first_row = tmp_regexes["data"].search(content, tmp_entry["offset"])
+	if tmp_first_row is None:
+		tmp_entry["cols"] = 0
+	else:
+		tmp_entry["cols"] = len(tmp_first_row.group().split())
+	
+	#offset, length and nb of rows of each frame (runs of data lines)
+	if args.frames:
+		tmp_entry["frames"] = []
+		for tmp_frame in tmp_regexes["frame"].finditer(content, tmp_entry["offset"]):
+			tmp_block = content[tmp_frame.start():tmp_frame.end()]
+			tmp_entry["frames"].append([tmp_frame.start(), len(tmp_block), tmp_block.count("\n") + (tmp_block[-1:] != "\n")])
+		tmp_entry["rows"] = sum([tmp_frame[2] for tmp_frame in tmp_entry["frames"]])
+
+	#read legends
+	tmp_entry["legends"] = []
+	for line in tmp_comments:
+		tmp_legend = tmp_regexes["legend"].match(line)
+		if tmp_legend is not None:
+			tmp_entry["legends"].append([int(tmp_legend.group(1)), tmp_legend.group(2)])
+	
+	#read weight (errors being reported by the main thread, as files are scanned in
+	#threads of the pool)
+	for line in tmp_comments:
+		if "weight" in line:
+			if "-> weight = " in line:
+				tmp_entry["weight"] = float(line.split("-> weight = ")[1])
+				if tmp_entry["weight"] < 0:
+					tmp_entry["error"] = "the weight in file " + str(filename) + " should be a positive number.\n -> " + str(line)
+			else:
+				print "\nWarning: keyword 'weight' found in the comments of file " + str(filename) + ", but weight not read in as the format '-> weight = ' wasn't found."
+	
+	return tmp_entry
+
+def infer_layout(legends, filename, layout_series):
+	
+	#the column of each series is that of the only legend containing its leaflet and
+	#metric, e.g. '@ s2 legend "upper (avg)"' for the column 3 of 'upper avg'
+	tmp_layout = {}
+	for series in layout_series:
+		tmp_leaflet, tmp_metric = series.split()
+		tmp_cols = []
+		for n, legend in legends:
+			if tmp_leaflet in legend.lower() and re.search(r"\b" + tmp_metric + r"\b", legend.lower()):
+				tmp_cols.append(n + 1)
+		if len(tmp_cols) != 1:
+			print "\nError: the column of '" + str(series) + "' couldn't be inferred from the legends of file " + str(filename) + " (" + str(len(tmp_cols)) + " matching legends)."
+			sys.exit(1)
+		tmp_layout[series] = tmp_cols[0]
+	
+	return tmp_layout
+
+def index_file(args, filename):
+	
+	#scan a file from a memory map of it
+	content = map_file(filename)
+	tmp_entry = scan_xvg(args, content, filename)
+	if len(content) > 0:
+		content.close()
+	
+	return tmp_entry
+
+def index_xvg(args):
+	
+	#entries of the files, those of the index of previous runs being kept (if the same
+	#comment characters were used) for the files which haven't changed
+	tmp_index = {"comments": args.comments, "files": {}}
+	if args.index != "none" and os.path.isfile(args.index):
+		with open(args.index) as f:
+			tmp_index = json.load(f)
+		if tmp_index["comments"] != args.comments:
+			tmp_index = {"comments": args.comments, "files": {}}
+	
+	#scan the files which are new or have been modified in a pool of threads
+	tmp_keys = [os.path.abspath(f) for f in args.xvgfilenames]
+	tmp_stats = [os.stat(f) for f in args.xvgfilenames]
+	tmp_to_scan = []
+	for f_index in range(0,len(args.xvgfilenames)):
+		tmp_entry = tmp_index["files"].get(tmp_keys[f_index])
+		if tmp_entry is None or "legends" not in tmp_entry or (args.frames and "frames" not in tmp_entry) or tmp_entry["mtime"] != tmp_stats[f_index].st_mtime or tmp_entry["size"] != tmp_stats[f_index].st_size:
+			tmp_to_scan.append(f_index)
+	xvg_entries = prefetch_xvg(args, functools.partial(index_file, args), [args.xvgfilenames[f_index] for f_index in tmp_to_scan], os.path.getsize)
+	tmp_progress = progress_init(args, "indexing file", len(tmp_to_scan))
+	for n in range(0,len(tmp_to_scan)):
+		if cancel_requested:
+			xvg_entries.close()
+			print "\n\nInterrupted while indexing the files."
+			sys.exit(1)
+		f_index = tmp_to_scan[n]
+		tmp_entry = xvg_entries.next()
+		tmp_entry["mtime"] = tmp_stats[f_index].st_mtime
+		tmp_entry["size"] = tmp_stats[f_index].st_size
+		tmp_index["files"][tmp_keys[f_index]] = tmp_entry
+		progress_update(tmp_progress, n + 1, tmp_entry["size"])
+	
+	#store index
+	if args.index != "none":
+		with open(args.index, 'w') as f:
+			json.dump(tmp_index, f)
+	
+	return [tmp_index["files"][tmp_keys[f_index]] for f_index in range(0,len(args.xvgfilenames))]
+
+def index_frames(args, xvg_index):
+	
+	#check that each file has the same number of frames, all with the same number of rows
+	#(returns these numbers)
+	nb_frames = len(xvg_index[0]["frames"])
+	if nb_frames == 0:
+		print "\nError: no frame found in file " + str(args.xvgfilenames[0]) + "."
+		sys.exit(1)
+	frame_rows = xvg_index[0]["frames"][0][2]
+	for f_index in range(0,len(args.xvgfilenames)):
+		filename = args.xvgfilenames[f_index]
+		if len(xvg_index[f_index]["frames"]) != nb_frames:
+			print "\nError: file " + str(filename) + " has " + str(len(xvg_index[f_index]["frames"])) + " frames, whereas file " + str(args.xvgfilenames[0]) + " has " + str(nb_frames) + " frames."
+			sys.exit(1)
+		for n in range(0, nb_frames):
+			if xvg_index[f_index]["frames"][n][2] != frame_rows:
+				print "\nError: frame " + str(n + 1) + " of file " + str(filename) + " has " + str(xvg_index[f_index]["frames"][n][2]) + " data rows, whereas frame 1 of file " + str(args.xvgfilenames[0]) + " has " + str(frame_rows) + " data rows."
+				sys.exit(1)
+	
+	return nb_frames, frame_rows
+
+def add_entry(args, filename, tmp_entry, ensemble, layouts, layout_series):
+	
+	#check the entry of a file against the ensemble (nb of data rows and columns, first
+	#file and columns to parse), the first file defining it (the nb of rows being already
+	#known from a checkpoint when resuming): returns the ensemble
+	nb_rows, nb_cols, first_file, usecols = ensemble
+	if "error" in tmp_entry:
+		print "\nError: " + tmp_entry["error"]
+		sys.exit(1)
+	if nb_cols is None:
+		nb_cols = tmp_entry["cols"]
+		if nb_rows is None:
+			nb_rows = tmp_entry["rows"]
+			first_file = filename
+		if args.membrane == "auto":
+			tmp_layout = infer_layout(tmp_entry["legends"], filename, layout_series)
+		else:
+			tmp_layout = layouts[args.membrane]
+		usecols = [0] + [tmp_layout[series] for series in layout_series]
+		if max(usecols) >= nb_cols:
+			print "\nError: file " + str(filename) + " has " + str(nb_cols) + " data columns, whereas column " + str(max(usecols)) + " is needed for membrane " + str(args.membrane) + "."
+			sys.exit(1)
+	
+	#check that each file has the same number of data rows and columns
+	if tmp_entry["rows"] != nb_rows:
+		print "\nError: file " + str(filename) + " has " + str(tmp_entry["rows"]) + " data rows, whereas file " + str(first_file) + " has " + str(nb_rows) + " data rows."
+		sys.exit(1)
+	if tmp_entry["cols"] != nb_cols:
+		print "\nError: file " + str(filename) + " has " + str(tmp_entry["cols"]) + " data columns, whereas file " + str(first_file) + " has " + str(nb_cols) + " data columns."
+		sys.exit(1)
+	
+	return nb_rows, nb_cols, first_file, usecols
+
+def valid_range(tmp_valid):
+	
+	#first and (last + 1) valid rows
+	tmp_rows = np.flatnonzero(tmp_valid)
+	if len(tmp_rows) == 0:
+		return 0, 0
+	
+	return tmp_rows[0], tmp_rows[-1] + 1
+
+#=========================================================================================
+# results cache
+#=========================================================================================
+
+def cache_key(args, prog, version_nb, script_file, layouts):
+	
+	#everything the result depends on: script (and its source), options (except those only affecting how
+	#the files are read or where the result goes), layouts and state of the input files
+	tmp_options = dict(vars(args))
+	for option in ["output_file", "file_list", "threads", "prefetch", "mmap", "index", "frame_batch", "progress", "progress_interval", "checkpoint", "resume", "cache_dir", "cache_size", "no_cache"]:
+		del tmp_options[option]
+	tmp_inputs = []
+	for f in args.xvgfilenames:
+		tmp_stat = os.stat(f)
+		tmp_inputs.append([f, os.path.abspath(f), tmp_stat.st_size, tmp_stat.st_mtime])
+	tmp_source = ""
+	for tmp_file in [script_file, __file__]:
+		with open(os.path.splitext(os.path.abspath(tmp_file))[0] + ".py") as f:
+			tmp_source += f.read()
+	tmp_key = json.dumps([prog, version_nb, hashlib.sha1(tmp_source).hexdigest(), tmp_options, layouts, tmp_inputs], sort_keys = True)
+	
+	return hashlib.sha1(tmp_key).hexdigest()
+
+def cache_fetch(args, tmp_key):
+	
+	#copy the cached output files, if any, as the output files of this run
+	tmp_dir = os.path.join(args.cache_dir, tmp_key)
+	if not os.path.isdir(tmp_dir):
+		return False
+	for tmp_file in os.listdir(tmp_dir):
+		shutil.copy(os.path.join(tmp_dir, tmp_file), os.getcwd() + '/' + str(args.output_file) + tmp_file[len("result"):])
+	os.utime(tmp_dir, None)
+	
+	return True
+
+def cache_store(args, tmp_key, tmp_suffixes):
+	
+	try:
+		#copy the output files in a temporary directory renamed once complete, so that
+		#other runs never see an incomplete result
+		if not os.path.isdir(args.cache_dir):
+			os.makedirs(args.cache_dir)
+		tmp_dir = tempfile.mkdtemp(dir = args.cache_dir)
+		for suffix in tmp_suffixes:
+			shutil.copy(os.getcwd() + '/' + str(args.output_file) + suffix, os.path.join(tmp_dir, "result" + suffix))
+		if os.path.isdir(os.path.join(args.cache_dir, tmp_key)):
+			shutil.rmtree(tmp_dir)
+		else:
+			os.rename(tmp_dir, os.path.join(args.cache_dir, tmp_key))
+		
+		#remove the least recently used results
+		tmp_entries = [os.path.join(args.cache_dir, d) for d in os.listdir(args.cache_dir) if not d.startswith("tmp")]
+		tmp_entries.sort(key = os.path.getmtime)
+		for tmp_entry in tmp_entries[:max(0, len(tmp_entries) - args.cache_size)]:
+			shutil.rmtree(tmp_entry)
+	except (OSError, IOError), e:
+		print "\nWarning: the result couldn't be cached (" + str(e) + ")."
+	
+	return
+
+#=========================================================================================
+# progress and cancellation
+#=========================================================================================
+
+def progress_init(args, stage, total, first = 0):
+	
+	#first: nb of items already done (e.g. when resuming), not counted in the rates
+	return {"stage": stage, "total": total, "first": first, "bytes": 0, "start": time.time(), "last": 0, "mode": args.progress, "interval": args.progress_interval}
+
+def progress_update(tmp_progress, done, nb_bytes = 0):
+	
+	#only one call to time() per item, the progress being shown at most every
+	#--progress_interval seconds (and when the stage is complete)
+	tmp_progress["bytes"] += nb_bytes
+	tmp_now = time.time()
+	if tmp_progress["mode"] == "none" or (tmp_now - tmp_progress["last"] < tmp_progress["interval"] and done < tmp_progress["total"]):
+		return
+	tmp_progress["last"] = tmp_now
+	
+	tmp_elapsed = max(tmp_now - tmp_progress["start"], 1e-6)
+	tmp_rate = (done - tmp_progress["first"]) / tmp_elapsed
+	tmp_mb_rate = tmp_progress["bytes"] / 1048576.0 / tmp_elapsed
+	tmp_eta = 0
+	if tmp_rate > 0:
+		tmp_eta = (tmp_progress["total"] - done) / tmp_rate
+	if tmp_progress["mode"] == "tty":
+		progress = '\r -' + tmp_progress["stage"] + ' ' + str(done) + '/' + str(tmp_progress["total"]) + ' (' + "{:.1f}".format(tmp_rate) + ' files/s, ' + "{:.1f}".format(tmp_mb_rate) + ' MB/s, ETA ' + "{:.0f}".format(tmp_eta) + ' s)          '
+	else:
+		progress = 'progress stage=' + tmp_progress["stage"].replace(" ", "_") + ' done=' + str(done) + ' total=' + str(tmp_progress["total"]) + ' files_per_s=' + "{:.1f}".format(tmp_rate) + ' mb_per_s=' + "{:.1f}".format(tmp_mb_rate) + ' eta_s=' + "{:.0f}".format(tmp_eta) + ' elapsed_s=' + "{:.0f}".format(tmp_elapsed) + '\n'
+	sys.stdout.write(progress)
+	sys.stdout.flush()
+	
+	return
+
+#set by the signal handler (signals being handled for the whole process)
+cancel_requested = False
+
+def request_cancel(signum, frame):
+	
+	#the files are read until the end of the current one, a second signal stopping the
+	#script straight away
+	global cancel_requested
+	if cancel_requested:
+		print "\n\nInterrupted."
+		sys.exit(1)
+	cancel_requested = True
+	
+	return
+
+def check_cancel(stage):
+	
+	#once the files are read there's nothing to keep for a later run: stop before the
+	#next stage
+	if cancel_requested:
+		print "\n\nInterrupted before " + stage + "."
+		sys.exit(1)
+	
+	return
+
+#=========================================================================================
+# checkpoints and partial results
+#=========================================================================================
+
+def write_npz(filename, tmp_arrays):
+	
+	#written in a temporary file renamed once complete, so that a checkpoint is never
+	#left incomplete
+	with open(filename + ".tmp", 'wb') as f:
+		np.savez(f, **tmp_arrays)
+	os.rename(filename + ".tmp", filename)
+	
+	return
+
+#=========================================================================================
+# robust estimators of the avg
+#=========================================================================================
+
+def sort_weights(data, weights):
+	
+	#sort each row (nan are sorted last and given a weight of 0) and cumulate the weights
+	tmp_order = np.argsort(data, axis = 1)
+	tmp_sorted = data[np.arange(np.shape(data)[0])[:,np.newaxis], tmp_order]
+	tmp_weights = weights[tmp_order]
+	tmp_weights[np.isnan(tmp_sorted)] = 0
+	tmp_cumsum = np.cumsum(tmp_weights, axis = 1)
+	tmp_total = tmp_cumsum[:,-1:]
+	
+	return tmp_sorted, tmp_weights, tmp_cumsum, tmp_total
+
+def weighted_quantile(tmp_sorted, tmp_cumsum, tmp_total, q):
+	
+	#value for which the cumulated weight goes over q (average of the two values when
+	#it exactly reaches q, as for the median of an even nb of values, and the last value
+	#when it never goes over q, as for q = 1)
+	tmp_rows = np.arange(np.shape(tmp_sorted)[0])
+	tmp_lower = np.argmax(tmp_cumsum >= q * tmp_total, axis = 1)
+	tmp_over = tmp_cumsum > q * tmp_total
+	tmp_upper = np.where(np.any(tmp_over, axis = 1), np.argmax(tmp_over, axis = 1), tmp_lower)
+	tmp_quantile = (tmp_sorted[tmp_rows, tmp_lower] + tmp_sorted[tmp_rows, tmp_upper]) / 2.0
+	tmp_quantile[tmp_total[:,0] == 0] = np.nan
+	
+	return tmp_quantile
+
+def calculate_estimator(data, weights, estimator, trim):
+	
+	#robust estimators of the weighted avg of each row, the sorting being done on all
+	#the rows at once
+	tmp_sorted, tmp_weights, tmp_cumsum, tmp_total = sort_weights(data, weights)
+	if estimator == "median":
+		tmp_avg = weighted_quantile(tmp_sorted, tmp_cumsum, tmp_total, 0.5)
+	elif estimator == "trimmed":
+		#only keep the weight between the trim and 1 - trim quantiles (partially for the
+		#values at the boundaries)
+		tmp_lower = trim * tmp_total
+		tmp_upper = (1 - trim) * tmp_total
+		tmp_weights_trimmed = np.clip(tmp_cumsum, tmp_lower, tmp_upper) - np.clip(tmp_cumsum - tmp_weights, tmp_lower, tmp_upper)
+		tmp_avg = np.nansum(tmp_weights_trimmed * tmp_sorted, axis = 1) / ((1 - 2 * trim) * tmp_total[:,0])
+	elif estimator == "winsorized":
+		#replace the values beyond the trim and 1 - trim quantiles by these quantiles
+		tmp_lower = weighted_quantile(tmp_sorted, tmp_cumsum, tmp_total, trim)
+		tmp_upper = weighted_quantile(tmp_sorted, tmp_cumsum, tmp_total, 1 - trim)
+		tmp_winsorized = np.clip(tmp_sorted, tmp_lower[:,np.newaxis], tmp_upper[:,np.newaxis])
+		tmp_avg = np.nansum(tmp_weights * tmp_winsorized, axis = 1) / tmp_total[:,0]
+	
+	return tmp_avg
+
+#=========================================================================================
+# bienayme std (xvg_average_op)
+#=========================================================================================
+
+def bienayme_sums(tmp_avg, tmp_std, tmp_nb, weights):
+
+	#sums over the files (columns) needed to calculate the weighted avg and the bienayme
+	#std of a leaflet (sums from different sets of files can simply be added)
+	
+	#weighted sum of the avg and nb of files where it's defined
+	tmp_sum = np.nansum(tmp_avg * weights, axis = 1)
+	tmp_nb_files = np.sum(~np.isnan(tmp_avg), axis = 1).astype(np.float64)
+	
+	#sum of the weighted variances
+	tmp_var = np.nansum(weights**2 * np.square(tmp_std, dtype = np.float64) * tmp_nb, axis = 1)
+	
+	#total number of points (+1 for each file with points)
+	tmp_nb_total = np.array(tmp_nb, dtype = np.float64)
+	tmp_nb_total[tmp_nb_total != 0] += 1
+	
+	return tmp_sum, tmp_nb_files, tmp_var, np.sum(tmp_nb_total, axis = 1)
+
+def bienayme_avg_std(tmp_sum, tmp_nb_files, tmp_var, tmp_nb, nb_files, weights_sum):
+
+	#weighted average taking into account "nan" (nb_files being the total nb of files)
+	tmp_nb_files = np.copy(tmp_nb_files)
+	tmp_nb_files[tmp_nb_files == 0] = np.nan
+	tmp_avg = tmp_sum * nb_files / float(weights_sum) / tmp_nb_files
+
+	#unbiased weighted std dev from Bienayme formula
+	# var(Xavg) = 1/(sum(wi))**2 * sum(wi**2 * var(Xi))
+	tmp_nb_total = tmp_nb - 1
+	tmp_nb_total[tmp_nb_total == 0] = 1
+	tmp_nb_total[tmp_nb_total == -1] = 1
+	tmp_std = np.sqrt(tmp_var / (weights_sum**2 * tmp_nb_total))
+
+	return tmp_avg, tmp_std
+
+#=========================================================================================
+# avg and std treated as metrics (xvg_average_op_simple)
+#=========================================================================================
+
+#the sums over the files are exact, so that they don't depend on the order of the files
+#nor on how they're split between partial results: each product is split into float64
+#slices, multiples of units 30 bits apart, whose sums are exact for up to 2**22 files
+#(the products being summed down to the last unit, ~1e-35, and up to ~1e28)
+moments_keys = ["n", "w", "w2", "s1", "s2", "min", "max"]
+moments_units = [2.0**k for k in [65, 35, 5, -25, -55, -85, -115]]
+moments_max = 2.0**94
+
+def moments_init(nb_rows):
+	
+	#nb of files, sums of the weights, squared weights, weighted values and weighted
+	#squared values (in slices) and range of the values, for each row
+	tmp_moments = {}
+	tmp_moments["n"] = np.zeros(nb_rows)
+	for m in ["w", "w2", "s1", "s2"]:
+		tmp_moments[m] = np.zeros((len(moments_units), nb_rows))
+	tmp_moments["min"] = np.full(nb_rows, np.inf)
+	tmp_moments["max"] = np.full(nb_rows, -np.inf)
+	
+	return tmp_moments
+
+def moments_product(a, b):
+	
+	#a * b as the sum of two float64 (Dekker's algorithm, exact barring overflow and
+	#underflow), each factor being split into two halves of 26 bits
+	tmp_halves = []
+	for tmp_factor in [a, b]:
+		tmp_big = 134217729.0 * tmp_factor
+		tmp_high = tmp_big - (tmp_big - tmp_factor)
+		tmp_halves.append([tmp_high, tmp_factor - tmp_high])
+	(a_high, a_low), (b_high, b_low) = tmp_halves
+	tmp_product = a * b
+	tmp_error = ((a_high * b_high - tmp_product) + a_high * b_low + a_low * b_high) + a_low * b_low
+	
+	return tmp_product, tmp_error
+
+def moments_slices(tmp_terms):
+	
+	#sum of the slices of the terms: the rest of each term is rounded to each unit in
+	#turn by adding and subtracting 1.5 * 2**52 times the unit
+	tmp_slices = np.zeros((len(moments_units),) + np.shape(tmp_terms[0]))
+	for tmp_rest in tmp_terms:
+		if np.any(np.abs(tmp_rest) >= moments_max):
+			raise ValueError("the weighted values and their squares should be below 1e28 in absolute value.")
+		for k in range(0, len(moments_units)):
+			tmp_shift = 1.5 * 2.0**52 * moments_units[k]
+			tmp_slice = (tmp_rest + tmp_shift) - tmp_shift
+			tmp_slices[k] += tmp_slice
+			tmp_rest = tmp_rest - tmp_slice
+	
+	return tmp_slices
+
+def moments_merge(tmp_moments, tmp_moments_other):
+	
+	#the sums of another set of files are simply added to tmp_moments (exactly)
+	for m in ["n", "w", "w2", "s1", "s2"]:
+		tmp_moments[m] += tmp_moments_other[m]
+	np.minimum(tmp_moments["min"], tmp_moments_other["min"], out = tmp_moments["min"])
+	np.maximum(tmp_moments["max"], tmp_moments_other["max"], out = tmp_moments["max"])
+	
+	return
+
+def moments_update(tmp_moments, data, weight, tmp_rows = None):
+	
+	#add the data of one file to the sums, nan being skipped (as well as the rows outside
+	#of tmp_rows if specified, the sums being updated through views of these rows)
+	if tmp_rows is not None:
+		tmp_moments = dict([[m, tmp_moments[m][..., tmp_rows]] for m in tmp_moments])
+		data = data[tmp_rows]
+	tmp_valid = ~np.isnan(data)
+	tmp_data = np.where(tmp_valid, data, 0).astype(np.float64)
+	tmp_moments_file = {}
+	tmp_moments_file["n"] = tmp_valid.astype(np.float64)
+	tmp_moments_file["w"] = moments_slices([np.array([weight], dtype = np.float64)]) * tmp_moments_file["n"]
+	tmp_moments_file["w2"] = moments_slices(moments_product(np.array([weight], dtype = np.float64), weight)) * tmp_moments_file["n"]
+	tmp_s1 = moments_product(weight, tmp_data)
+	tmp_moments_file["s1"] = moments_slices(tmp_s1)
+	tmp_moments_file["s2"] = moments_slices(moments_product(tmp_s1[0], tmp_data) + moments_product(tmp_s1[1], tmp_data))
+	tmp_moments_file["min"] = np.where(tmp_valid, tmp_data, np.inf)
+	tmp_moments_file["max"] = np.where(tmp_valid, tmp_data, -np.inf)
+	moments_merge(tmp_moments, tmp_moments_file)
+	
+	return
+
+def moments_total(tmp_moments, m):
+	
+	#exact sums of the slices of each row, as (long) integer nbs of the last unit
+	return [sum([long(v) for v in tmp_row]) for tmp_row in (tmp_moments[m] / moments_units[-1]).T.tolist()]
+
+def moments_std(tmp_moments, tmp_m2):
+	
+	#unbiased weighted std dev (with reliability weights) from the sum of weighted squared
+	#deviations tmp_m2:
+	# std**2 = sum(wi) / (sum(wi)**2 - sum(wi**2)) * sum(wi * (Xi - avg)**2)
+	tmp_scale = long(1 / moments_units[-1])
+	tmp_w = moments_total(tmp_moments, "w")
+	tmp_w2 = moments_total(tmp_moments, "w2")
+	tmp_factor = np.zeros(len(tmp_w))
+	for r in range(0, len(tmp_w)):
+		tmp_div = tmp_w[r]**2 - tmp_w2[r] * tmp_scale
+		if tmp_div != 0:
+			tmp_factor[r] = operator.truediv(tmp_w[r] * tmp_scale, tmp_div)
+	
+	return np.sqrt(tmp_factor * tmp_m2)
+
+def moments_avg_std(tmp_moments):
+	
+	#weighted avg (nan for the rows without data) and unbiased weighted std dev, each
+	#rounded once from the exact sums (the std being 0 if all the values are equal):
+	# avg = sum(wi * Xi) / sum(wi)
+	# std**2 = (sum(wi) * sum(wi * Xi**2) - sum(wi * Xi)**2) / (sum(wi)**2 - sum(wi**2))
+	tmp_scale = long(1 / moments_units[-1])
+	tmp_w, tmp_w2, tmp_s1, tmp_s2 = [moments_total(tmp_moments, m) for m in ["w", "w2", "s1", "s2"]]
+	tmp_avg = np.zeros(len(tmp_w))
+	tmp_var = np.zeros(len(tmp_w))
+	for r in range(0, len(tmp_w)):
+		if tmp_moments["n"][r] == 0:
+			tmp_avg[r] = np.nan
+		elif tmp_w[r] != 0:
+			tmp_avg[r] = operator.truediv(tmp_s1[r], tmp_w[r])
+		tmp_div = tmp_w[r]**2 - tmp_w2[r] * tmp_scale
+		if tmp_div != 0 and tmp_moments["min"][r] < tmp_moments["max"][r]:
+			tmp_var[r] = max(0, operator.truediv(tmp_w[r] * tmp_s2[r] - tmp_s1[r]**2, tmp_div))
+	
+	return tmp_avg, np.sqrt(tmp_var)
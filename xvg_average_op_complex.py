@@ -4,6 +4,10 @@ import operator
 from operator import itemgetter
 import sys, os, shutil
 import os.path
+import functools
+import json
+import time
+import signal
 
 ##########################################################################################
 # RETRIEVE USER INPUTS
@@ -33,14 +37,158 @@ the script may give out a warning 'return np.mean(x,axis)/factor', it's ok. it's
 scipy warning us that there were only nans on a row, the result will be a nan as we
 expect (see this thread: https://github.com/scipy/scipy/issues/2898).
 
+--precision 32 halves the memory used to store the data read in (avg, std and nb of
+each file are kept as float32, which holds integer counts exactly up to 2**24 and still
+allows the 'nan' of empty rows). The sums are always accumulated in float64: float32
+storage introduces a relative error of at most ~6e-8 on each input value, i.e. well
+below both the ~6 significant digits of the inputs and the '%.6e' format of the output.
+
+Each file is indexed (weight, nb of header lines, rows and columns) by the thread which
+reads it, so that it is only read once, and is checked against the first file before its
+data is parsed. With --index the files are indexed in a first pass (in the same pool of
+threads), so that an ensemble with inconsistent files is rejected before any data is
+parsed, and the index is kept in a json file so that only the files modified since the
+previous run are indexed again. The files are always indexed first with --frames.
+
+The files are read by --threads threads ahead of their parsing, as long as the files
+read and not parsed yet (including the one being parsed) total at most --prefetch MB, a
+larger file only being read once the previous ones are parsed. Reading the files thus
+takes about --prefetch MB of memory (or the size of the largest file, if larger), plus
+the list of lines of the file being parsed without --mmap, on top of the data stored.
+
+The avg of each row is by default the weighted mean over the files. Robust estimators,
+less sensitive to outlier files, can be used instead with --estimator: the weighted
+median, the weighted mean of the values between the --trim and 1 - --trim weighted
+quantiles ('trimmed') or the weighted mean after replacing the values beyond these
+quantiles by the quantiles themselves ('winsorized'). The std is still calculated with
+the Bienayme formula.
+
+The files can be averaged in several goes (e.g. on different nodes): with --partial the
+sums over the files specified (which are all the average depends on) are written to a
+.npz file, and with --merge the .npz files of several runs are added to give the
+average xvg. Only the mean estimator can be used in this case.
+
+The columns read for each membrane are defined in xvg_average_op_layouts.ini (next to
+the scripts, with xvg_average_op_common.py), with a section per membrane and a line per
+series ('upper avg', 'upper std', 'upper nb', 'lower avg', 'lower std' and 'lower nb').
+Other membranes can be added there or in a --layouts file with the same format:
+ [POPC]
+ upper avg = 8
+ upper std = 10
+ upper nb = 12
+ ...
+With --membrane auto the columns are found from the legends of the first file (the
+legend of 'upper avg' should be the only one containing 'upper' and 'avg', etc). Only
+the columns needed are parsed.
+
+For large files --mmap reduces the memory needed to parse them: the numbers are parsed
+by numpy directly from a memory map of the file, from the end of the header, rather
+than from a list of lines. The comment lines must all be at the top of the files.
+
+The results are cached: if the same files (same path, size and modification time) are
+averaged again with the same options and layouts and by the same version of the code
+(same source of the script and of xvg_average_op_common.py), the outputs of the previous
+run are simply copied, the output path and duration in the --summary being those of the
+new run. Only the --cache_size most recently used results are kept.
+
+The extra outputs are calculated from the data already in memory, without reading the
+files again. For --diagnostics the rms deviation of each file is calculated over the
+rows where both the file and the average are defined, for the upper and lower avg; a
+file is flagged as an outlier if either is more than --outlier times 1.4826 x the
+median absolute deviation above the median over the files.
+
+With --frames the files can hold a time series: blocks of data rows (one per frame, all
+with the same nb of rows) separated by comment lines, '&' lines or blank lines. Each
+frame is averaged over the files separately, --frame_batch frames at a time: the rows of
+these frames are processed together as a single table, and only these frames are held in
+memory whatever the nb of frames in the files. Each frame of the output is preceded by a
+'# frame' comment line. --frames can't be used with --partial, --merge or the extra
+outputs (--coverage, --diagnostics and --summary).
+
+With --sparse only the rows of each file between its first and last rows with data (rows
+which don't have both a 'nan' avg and a nb of 0) are kept, for each leaflet, and the sums
+are only calculated over these rows: the memory and time needed then depend on the nb of
+rows with data rather than on the total nb of rows of the files. It can only be used
+with the mean estimator and without --diagnostics (which need the data of all the rows).
+
+The progress is shown on the terminal (--progress tty) or written as structured lines
+('progress stage=reading_file done=10 total=100 ...', --progress log, e.g. for
+the logs of batch schedulers), in both cases at most every --progress_interval seconds,
+along with the nb of files and MB read per second and the estimated time left.
+
+If the script is interrupted (SIGINT or SIGTERM) while the files are read, it stops after
+the current file: the files read are averaged in op_avg_interrupted.xvg, their sums are
+written in op_avg_interrupted.npz (as with --partial) and the files left are listed in
+op_avg_interrupted_remaining.txt, so that the run can be completed (mean estimator only)
+by running the script with the other options of the interrupted run and:
+ --file_list op_avg_interrupted_remaining.txt --partial -o op_avg_remaining
+ -f op_avg_interrupted.npz op_avg_remaining.npz --merge
+With --frames it stops after the current batch of frames. Once the files are read (or
+with --merge) it stops before the next stage (calculating or writing each output), the
+outputs written so far being kept but not cached, and a signal received while the last
+output is written is reported: in all these cases the exit code is 1. A second signal
+stops the script straight away.
+
+With --checkpoint N the Bienayme sums of the files read are saved in op_avg.ckpt.npz
+every N files (and when the script is interrupted, along with the data of the files
+read since the last checkpoint), and with --resume a run started again with the same
+files and options continues from the last checkpoint rather than from the first file,
+the result being exactly the same as that of an uninterrupted run with the same N (the
+sums being added N files at a time). The data itself is only needed by the robust
+estimators and --diagnostics: the data of the N files read since the previous
+checkpoint is then also written in a new chunk file (op_avg.ckpt.0.npz, ...), so that
+each file is only written once. The checkpoint files are removed once the run is
+complete.
+
+With --kernel numba the Bienayme sums (weighted avg, nb of files, weighted variances and
+nb of points of each row) are calculated by a compiled kernel going over the data of
+both leaflets a single time, rather than by several numpy operations each going over all
+the data (--kernel numpy, which is also used if numba isn't installed). The two kernels
+can be compared with xvg_average_op_benchmark.py --options='--kernel numba'. The compiled
+kernel adds the files one after the other rather than pairwise as numpy does, which can
+change the last digit of a few values. It isn't used with --sparse.
+
 [ USAGE ]
 
 Option	      Default  	Description                    
 -----------------------------------------------------
 -f			: xvg file(s)
+--file_list	none	: file listing xvg files, one per line (added to those of -f, e.g.
+			  for ensembles too large for a command line)
 -o		op_avg	: name of outptut file
---membrane		: 'AM_zCter','AM_zNter','SMa','SMz' or 'POPC'
+--membrane		: 'AM_zCter','AM_zNter','SMa','SMz','POPC', a membrane of the
+			  --layouts file or 'auto' (see NB above)
+--layouts	none	: file defining the columns of other membranes
 --comments	@,#	: lines starting with these characters will be considered as comment
+--precision	64	: storage precision of the data read in ('64' or '32', see NB above)
+--threads	4	: nb of threads reading (and indexing) the files ahead of their parsing
+--prefetch	64	: max size (MB) of the files read ahead and waiting to be parsed
+--mmap			: parse the files straight from memory maps (see NB above)
+--index		none	: json file where to keep the index of the files (see NB above)
+--sparse		: only keep and process the rows of each file with data (see NB above)
+--kernel	numpy	: 'numpy' or 'numba', how the Bienayme sums are calculated (see NB above)
+--estimator	mean	: 'mean', 'median', 'trimmed' or 'winsorized' (see NB above)
+--trim		0.1	: fraction of the weight trimmed or winsorized at each end
+--partial		: write the sums needed to calculate the average in the file
+			  'op_avg.npz' instead of calculating the average (see NB above)
+--merge			: calculate the average from -f files written with --partial
+--cache_dir	~/.xvg_average_op
+			: directory where the results are cached (see NB above)
+--cache_size	100	: max nb of results kept in the cache
+--no-cache		: calculate the average even if it's in the cache
+--coverage		: also write the nb of files with data for each row (op_avg_coverage.xvg)
+--diagnostics		: also write the rms deviation of each file from the average and flag
+			  outliers (op_avg_files.txt, see NB above)
+--outlier	3	: nb of (MAD estimated) std dev above the median rms deviation from which
+			  a file is flagged as an outlier
+--summary		: also write a summary of the run (op_avg_summary.json)
+--frames		: average each frame of the files separately (see NB above)
+--frame_batch	10	: nb of frames read and averaged at once
+--progress	tty	: how to show the progress: 'tty', 'log' or 'none' (see NB above)
+--progress_interval	1
+			: min nb of seconds between two progress updates
+--checkpoint	0	: save what was read every N files (0: never, see NB above)
+--resume		: continue from the checkpoint of a previous run, if any
 
 Other options
 -----------------------------------------------------
@@ -50,10 +198,36 @@ Other options
 ''')
 
 #options
-parser.add_argument('-f', nargs='+', dest='xvgfilenames', help=argparse.SUPPRESS, required=True)
+parser.add_argument('-f', nargs='+', dest='xvgfilenames', default=[], help=argparse.SUPPRESS)
+parser.add_argument('--file_list', nargs=1, dest='file_list', default=['none'], help=argparse.SUPPRESS)
 parser.add_argument('-o', nargs=1, dest='output_file', default=["op_avg"], help=argparse.SUPPRESS)
-parser.add_argument('--membrane', dest='membrane', choices=['AM_zCter','AM_zNter','SMa','SMz','POPC'], default='not specified', help=argparse.SUPPRESS, required=True)
+parser.add_argument('--membrane', dest='membrane', default='not specified', help=argparse.SUPPRESS, required=True)
+parser.add_argument('--layouts', nargs=1, dest='layouts', default=['none'], help=argparse.SUPPRESS)
 parser.add_argument('--comments', nargs=1, dest='comments', default=['@,#'], help=argparse.SUPPRESS)
+parser.add_argument('--precision', dest='precision', choices=['64','32'], default='64', help=argparse.SUPPRESS)
+parser.add_argument('--threads', nargs=1, dest='threads', default=[4], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--prefetch', nargs=1, dest='prefetch', default=[64], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--mmap', dest='mmap', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--index', nargs=1, dest='index', default=['none'], help=argparse.SUPPRESS)
+parser.add_argument('--sparse', dest='sparse', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--kernel', dest='kernel', choices=['numpy','numba'], default='numpy', help=argparse.SUPPRESS)
+parser.add_argument('--estimator', dest='estimator', choices=['mean','median','trimmed','winsorized'], default='mean', help=argparse.SUPPRESS)
+parser.add_argument('--trim', nargs=1, dest='trim', default=[0.1], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--partial', dest='partial', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--merge', dest='merge', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--cache_dir', nargs=1, dest='cache_dir', default=['~/.xvg_average_op'], help=argparse.SUPPRESS)
+parser.add_argument('--cache_size', nargs=1, dest='cache_size', default=[100], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--no-cache', dest='no_cache', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--coverage', dest='coverage', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--diagnostics', dest='diagnostics', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--outlier', nargs=1, dest='outlier', default=[3], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--summary', dest='summary', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--frames', dest='frames', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--frame_batch', nargs=1, dest='frame_batch', default=[10], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--progress', dest='progress', choices=['tty','log','none'], default='tty', help=argparse.SUPPRESS)
+parser.add_argument('--progress_interval', nargs=1, dest='progress_interval', default=[1], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--checkpoint', nargs=1, dest='checkpoint', default=[0], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--resume', dest='resume', action='store_true', help=argparse.SUPPRESS)
 
 #other options
 parser.add_argument('--version', action='version', version='%(prog)s v' + version_nb, help=argparse.SUPPRESS)
@@ -64,8 +238,20 @@ parser.add_argument('-h','--help', action='help', help=argparse.SUPPRESS)
 #=========================================================================================
 
 args = parser.parse_args()
+args.file_list = args.file_list[0]
 args.output_file = args.output_file[0]
 args.comments = args.comments[0].split(',')
+args.layouts = args.layouts[0]
+args.threads = args.threads[0]
+args.prefetch = args.prefetch[0]
+args.index = args.index[0]
+args.trim = args.trim[0]
+args.cache_dir = os.path.expanduser(args.cache_dir[0])
+args.cache_size = args.cache_size[0]
+args.outlier = args.outlier[0]
+args.frame_batch = args.frame_batch[0]
+args.progress_interval = args.progress_interval[0]
+args.checkpoint = args.checkpoint[0]
 
 #=========================================================================================
 # import modules (doing it now otherwise might crash before we can display the help menu!)
@@ -84,143 +270,606 @@ except:
 	print "Error: you need to install the scipy module."
 	sys.exit(1)
 
+#code shared by the xvg_average_op scripts
+try:
+	import xvg_average_op_common as common
+except ImportError:
+	print "Error: xvg_average_op_common.py should be in the same directory as " + str(parser.prog) + ".py."
+	sys.exit(1)
+
+#optional compiled kernel
+if args.kernel == "numba":
+	try:
+		import numba
+	except ImportError:
+		print "Warning: the numba module isn't installed, the numpy kernel will be used instead."
+		args.kernel = "numpy"
+
+#storage type of the data read in (sums are always accumulated in float64)
+if args.precision == "32":
+	data_dtype = np.float32
+else:
+	data_dtype = np.float64
+
 #=======================================================================
 # sanity check
 #=======================================================================
 
-if len(args.xvgfilenames) == 1:
+if args.file_list != "none":
+	if not os.path.isfile(args.file_list):
+		print "Error: file " + str(args.file_list) + " not found."
+		sys.exit(1)
+	with open(args.file_list) as f:
+		args.xvgfilenames += [line.strip() for line in f if line.strip() != ""]
+
+if len(args.xvgfilenames) == 0:
+	print "Error: no data file specified (use -f or --file_list)."
+	sys.exit(1)
+
+if len(args.xvgfilenames) == 1 and not args.partial and not args.merge:
 	print "Error: only 1 data file specified."
 	sys.exit(1)
+
+if args.partial and args.merge:
+	print "Error: --partial and --merge can't be used together."
+	sys.exit(1)
+
+if (args.partial or args.merge) and args.estimator != "mean":
+	print "Error: only the mean estimator can be used with --partial or --merge."
+	sys.exit(1)
+
+if args.sparse and (args.estimator != "mean" or args.diagnostics):
+	print "Error: --sparse can only be used with the mean estimator and without --diagnostics."
+	sys.exit(1)
+
+if args.threads < 1 or args.prefetch < 1:
+	print "Error: --threads and --prefetch should be at least 1."
+	sys.exit(1)
+
+if args.partial and (args.coverage or args.diagnostics or args.summary):
+	print "Error: --coverage, --diagnostics and --summary can't be used with --partial."
+	sys.exit(1)
+
+if args.merge and args.diagnostics:
+	print "Error: --diagnostics can't be used with --merge (the data of each file isn't kept in partial results)."
+	sys.exit(1)
+
+if args.frames and (args.partial or args.merge or args.coverage or args.diagnostics or args.summary):
+	print "Error: --partial, --merge, --coverage, --diagnostics and --summary can't be used with --frames."
+	sys.exit(1)
+
+if args.checkpoint < 0:
+	print "Error: --checkpoint should be 0 or more."
+	sys.exit(1)
+
+if (args.checkpoint > 0 or args.resume) and (args.merge or args.frames):
+	print "Error: --checkpoint and --resume can't be used with --merge or --frames."
+	sys.exit(1)
+
+if args.frame_batch < 1:
+	print "Error: --frame_batch should be at least 1."
+	sys.exit(1)
+
+if args.cache_size < 1:
+	print "Error: --cache_size should be at least 1."
+	sys.exit(1)
+
+if args.trim < 0 or args.trim >= 0.5:
+	print "Error: --trim should be between 0 and 0.5 (excluded)."
+	sys.exit(1)
 	
 for f in args.xvgfilenames:
 	if not os.path.isfile(f):
 		print "Error: file " + str(f) + " not found."
 		sys.exit(1)
 
+#=======================================================================
+# column layouts
+#=======================================================================
+
+#series read in the input files
+layout_series = ["upper avg", "upper std", "upper nb", "lower avg", "lower std", "lower nb"]
+
+#column of each series in the input files for each membrane: the layouts shipped in
+#xvg_average_op_layouts.ini, then those of the --layouts file (same format)
+tmp_layouts_files = [common.layouts_file]
+if args.layouts != "none":
+	tmp_layouts_files.append(args.layouts)
+layouts = {}
+for tmp_file in tmp_layouts_files:
+	try:
+		common.read_layouts(tmp_file, layout_series, layouts)
+	except ValueError, e:
+		print "Error: " + str(e)
+		sys.exit(1)
+
+if args.membrane != "auto" and args.membrane not in layouts:
+	print "Error: membrane should be 'auto' or one of " + ", ".join(sorted(layouts)) + "."
+	sys.exit(1)
+
 ##########################################################################################
 # FUNCTIONS DEFINITIONS
 ##########################################################################################
 
+#=========================================================================================
+# checkpoints
+#=========================================================================================
+
+def checkpoint_chunk_file(k):
+	
+	#chunk files holding the data of the files read between two checkpoints
+	return os.getcwd() + '/' + str(args.output_file) + '.ckpt.' + str(k) + '.npz'
+
+def checkpoint_stacks(f_start, f_stop):
+	
+	#data of the files f_start to f_stop - 1
+	tmp_stacks = {}
+	if args.sparse:
+		#blocks of the files put end to end
+		for leaflet in ["upper", "lower"]:
+			tmp_stacks[leaflet + "_starts"] = np.array([tmp_start for tmp_start, tmp_packed in data_op_sparse[leaflet][f_start:f_stop]], dtype = int)
+			tmp_stacks[leaflet + "_lengths"] = np.array([np.shape(tmp_packed)[0] for tmp_start, tmp_packed in data_op_sparse[leaflet][f_start:f_stop]], dtype = int)
+			tmp_stacks[leaflet + "_packed"] = np.concatenate([tmp_packed for tmp_start, tmp_packed in data_op_sparse[leaflet][f_start:f_stop]] + [np.zeros((0, 3), dtype = data_dtype)])
+	else:
+		tmp_stacks["upper_avg"] = data_op_upper_avg[:, f_start + 1:f_stop + 1]
+		tmp_stacks["upper_std"] = data_op_upper_std[:, f_start:f_stop]
+		tmp_stacks["upper_nb"] = data_op_upper_nb[:, f_start:f_stop]
+		tmp_stacks["lower_avg"] = data_op_lower_avg[:, f_start + 1:f_stop + 1]
+		tmp_stacks["lower_std"] = data_op_lower_std[:, f_start:f_stop]
+		tmp_stacks["lower_nb"] = data_op_lower_nb[:, f_start:f_stop]
+	
+	return tmp_stacks
+
+def restore_stacks(tmp_stacks, f_start, f_stop):
+	
+	#data of the files f_start to f_stop - 1 (sparse blocks being added after those of
+	#the previous files)
+	if args.sparse:
+		for leaflet in ["upper", "lower"]:
+			tmp_ends = np.cumsum(tmp_stacks[leaflet + "_lengths"])
+			for f_index in range(0, f_stop - f_start):
+				tmp_packed = tmp_stacks[leaflet + "_packed"][tmp_ends[f_index] - tmp_stacks[leaflet + "_lengths"][f_index]:tmp_ends[f_index]]
+				data_op_sparse[leaflet].append([tmp_stacks[leaflet + "_starts"][f_index], tmp_packed])
+	else:
+		data_op_upper_avg[:, f_start + 1:f_stop + 1] = tmp_stacks["upper_avg"]
+		data_op_upper_std[:, f_start:f_stop] = tmp_stacks["upper_std"]
+		data_op_upper_nb[:, f_start:f_stop] = tmp_stacks["upper_nb"]
+		data_op_lower_avg[:, f_start + 1:f_stop + 1] = tmp_stacks["lower_avg"]
+		data_op_lower_std[:, f_start:f_stop] = tmp_stacks["lower_std"]
+		data_op_lower_nb[:, f_start:f_stop] = tmp_stacks["lower_nb"]
+	
+	return
+
+def accumulate_checkpoint(nb_done):
+	
+	global checkpoint_done
+	global checkpoint_sums
+	
+	#add the sums of the files read since the last checkpoint to those of the checkpoint,
+	#their data being written in a new chunk file only if it's needed to calculate the
+	#outputs (so that each file is only written once)
+	tmp_sums = calculate_sums(checkpoint_done, nb_done)
+	if checkpoint_done == 0:
+		checkpoint_sums = tmp_sums
+	else:
+		for key in checkpoint_sums:
+			checkpoint_sums[key] = checkpoint_sums[key] + tmp_sums[key]
+	if checkpoint_data:
+		common.write_npz(checkpoint_chunk_file(len(checkpoint_chunks)), checkpoint_stacks(checkpoint_done, nb_done))
+		checkpoint_chunks.append(nb_done)
+	checkpoint_done = nb_done
+	
+	return
+
+def write_checkpoint(nb_done):
+	
+	#sums of the files read up to the last checkpoint and data of those read since then
+	#(fewer than --checkpoint, unless the run is interrupted)
+	tmp_checkpoint = checkpoint_stacks(checkpoint_done, nb_done)
+	tmp_checkpoint["key"] = checkpoint_key
+	tmp_checkpoint["nb_done"] = nb_done
+	tmp_checkpoint["checkpoint_done"] = checkpoint_done
+	tmp_checkpoint["chunks"] = np.array(checkpoint_chunks, dtype = int)
+	tmp_checkpoint["distances"] = distances
+	tmp_checkpoint["weights"] = weights[:nb_done]
+	if checkpoint_done > 0:
+		for key in checkpoint_sums:
+			tmp_checkpoint["sums_" + key] = checkpoint_sums[key]
+	common.write_npz(checkpoint_file, tmp_checkpoint)
+	
+	return
+
+def read_checkpoint():
+	
+	global distances
+	global nb_rows
+	global first_file
+	global checkpoint_done
+	global checkpoint_sums
+	global checkpoint_chunks
+	
+	#checkpoint of a previous run (None if there's none), the nb of rows and weights of
+	#the files it holds being known from it
+	if not os.path.isfile(checkpoint_file):
+		print "\nWarning: no checkpoint found (" + str(checkpoint_file) + "), starting from the first file."
+		return None
+	tmp_checkpoint = np.load(checkpoint_file)
+	if str(tmp_checkpoint["key"]) != checkpoint_key:
+		print "\nError: the checkpoint " + str(checkpoint_file) + " was written for different files, options or layouts, or by another version of the script (remove it to start from the first file)."
+		sys.exit(1)
+	nb_done = int(tmp_checkpoint["nb_done"])
+	distances = tmp_checkpoint["distances"]
+	if nb_rows is not None and len(distances) != nb_rows:
+		print "\nError: the checkpoint " + str(checkpoint_file) + " has " + str(len(distances)) + " data rows, whereas file " + str(first_file) + " has " + str(nb_rows) + " data rows."
+		sys.exit(1)
+	nb_rows = len(distances)
+	first_file = checkpoint_file
+	weights[:nb_done] = tmp_checkpoint["weights"]
+	checkpoint_done = int(tmp_checkpoint["checkpoint_done"])
+	if checkpoint_done > 0:
+		checkpoint_sums = {}
+		for leaflet in ["upper", "lower"]:
+			for key in ["_sum", "_nb_files", "_var", "_nb"]:
+				checkpoint_sums[leaflet + key] = tmp_checkpoint["sums_" + leaflet + key]
+	checkpoint_chunks = list(tmp_checkpoint["chunks"])
+	for k in range(0, len(checkpoint_chunks)):
+		if not os.path.isfile(checkpoint_chunk_file(k)):
+			print "\nError: the chunk file " + str(checkpoint_chunk_file(k)) + " of the checkpoint is missing (remove " + str(checkpoint_file) + " to start from the first file)."
+			sys.exit(1)
+	
+	return tmp_checkpoint
+
+def restore_checkpoint(tmp_checkpoint):
+	
+	#data of the files held by the checkpoint, if needed, (returns their nb) the files
+	#whose sums are in the checkpoint being given empty sparse blocks otherwise
+	if not args.sparse:
+		data_op_upper_avg[:,0] = distances
+		data_op_lower_avg[:,0] = distances
+	if checkpoint_data:
+		tmp_start = 0
+		for k in range(0, len(checkpoint_chunks)):
+			restore_stacks(np.load(checkpoint_chunk_file(k)), tmp_start, checkpoint_chunks[k])
+			tmp_start = checkpoint_chunks[k]
+	elif args.sparse:
+		for leaflet in ["upper", "lower"]:
+			data_op_sparse[leaflet] += [[0, np.zeros((0, 3), dtype = data_dtype)] for f_index in range(0, checkpoint_done)]
+	nb_done = int(tmp_checkpoint["nb_done"])
+	restore_stacks(tmp_checkpoint, checkpoint_done, nb_done)
+	
+	return nb_done
+
+def remove_checkpoint():
+	
+	#checkpoint and chunk files (including that of a run stopped while writing one)
+	for tmp_file in [checkpoint_file] + [checkpoint_chunk_file(k) for k in range(0, len(checkpoint_chunks) + 1)]:
+		if os.path.isfile(tmp_file):
+			os.remove(tmp_file)
+	
+	return
+
 #=========================================================================================
 # data loading
 #=========================================================================================
 
-def load_xvg():															#DONE
+def index_xvg():
+	
+	global xvg_index
+	global nb_frames
+	global frame_rows
+	
+	#check that each file has the same number of data rows and columns (and frames)
+	xvg_index = common.index_xvg(args)
+	for f_index in range(0,len(args.xvgfilenames)):
+		add_entry(f_index, xvg_index[f_index])
+	if args.frames:
+		nb_frames, frame_rows = common.index_frames(args, xvg_index)
+	
+	return
+
+def add_entry(f_index, tmp_entry):
 	
 	global nb_rows
 	global nb_cols
+	global first_file
+	global usecols
+	nb_rows, nb_cols, first_file, usecols = common.add_entry(args, args.xvgfilenames[f_index], tmp_entry, [nb_rows, nb_cols, first_file, usecols], layouts, layout_series)
+	weights[f_index] = tmp_entry["weight"]
+	
+	return
+
+def allocate_data():
+	
+	global data_op_upper_avg
+	global data_op_upper_std
+	global data_op_upper_nb
+	global data_op_lower_avg
+	global data_op_lower_std
+	global data_op_lower_nb
+	global data_op_sparse
+	
+	if args.sparse:
+		data_op_sparse = {"upper": [], "lower": []}											#first row and avg, std and nb of the rows with data for each file
+	else:
+		data_op_upper_avg = np.zeros((nb_rows, len(args.xvgfilenames) + 1), dtype = data_dtype)			#distance, avg op upper for each file
+		data_op_upper_std = np.zeros((nb_rows, len(args.xvgfilenames)), dtype = data_dtype)				#std op upper for each file
+		data_op_upper_nb = np.zeros((nb_rows, len(args.xvgfilenames)), dtype = data_dtype)				#nb op upper for each file
+		data_op_lower_avg = np.zeros((nb_rows, len(args.xvgfilenames) + 1), dtype = data_dtype)			#distance, avg op upper for each file
+		data_op_lower_std = np.zeros((nb_rows, len(args.xvgfilenames)), dtype = data_dtype)				#std op upper for each file
+		data_op_lower_nb = np.zeros((nb_rows, len(args.xvgfilenames)), dtype = data_dtype)				#nb op upper for each file
+	
+	return
+
+def load_xvg(tmp_frames = None):										#DONE
+	
 	global weights
+	global files_remaining
+	global distances
 	global data_op_upper_avg
 	global data_op_upper_std
 	global data_op_upper_nb
 	global data_op_lower_avg
 	global data_op_lower_std
 	global data_op_lower_nb
-	nb_rows = 0
-	nb_cols = 0
-	weights = np.ones(len(args.xvgfilenames))
-		
-	for f_index in range(0,len(args.xvgfilenames)):
-		#display progress
-		progress = '\r -reading file ' + str(f_index+1) + '/' + str(len(args.xvgfilenames)) + '                      '  
-		sys.stdout.flush()
-		sys.stdout.write(progress)
+	files_remaining = []
+	nb_done = 0
+	
+	#continue from the checkpoint of a previous run, the files it holds not being read
+	tmp_checkpoint = None
+	if args.resume:
+		tmp_checkpoint = read_checkpoint()
+	
+	#the size of the ensemble is known from the index or the checkpoint, if any, and
+	#otherwise from the first file read
+	if nb_rows is not None:
+		allocate_data()
+	if tmp_checkpoint is not None:
+		nb_done = restore_checkpoint(tmp_checkpoint)
+	
+	if tmp_frames is None:
+		xvg_contents = common.prefetch_xvg(args, functools.partial(common.read_xvg, args, xvg_index is not None), args.xvgfilenames[nb_done:], os.path.getsize)
+		tmp_progress = common.progress_init(args, "reading file", len(args.xvgfilenames), nb_done)
+	else:
+		#only the frames of the batch are read (nb_rows being their total nb of rows)
+		xvg_contents = common.prefetch_xvg(args, common.read_block, [[args.xvgfilenames[f_index]] + xvg_index[f_index]["frames"][n][:2] for f_index in range(0,len(args.xvgfilenames)) for n in tmp_frames], lambda tmp_block: tmp_block[2])
+		tmp_progress = common.progress_init(args, "reading frames " + str(tmp_frames[0]+1) + "-" + str(tmp_frames[-1]+1) + "/" + str(nb_frames) + " of file", len(args.xvgfilenames))
+	
+	for f_index in range(nb_done,len(args.xvgfilenames)):
+		#stop if the run is interrupted, only keeping the files read
+		if common.cancel_requested and tmp_frames is None:
+			xvg_contents.close()
+			if f_index == nb_done:
+				print "\n\nInterrupted before any file was read."
+				sys.exit(1)
+			if args.checkpoint > 0:
+				write_checkpoint(f_index)
+			files_remaining = args.xvgfilenames[f_index:]
+			args.xvgfilenames = args.xvgfilenames[:f_index]
+			weights = weights[:f_index]
+			if not args.sparse:
+				data_op_upper_avg = data_op_upper_avg[:, :f_index + 1]
+				data_op_upper_std = data_op_upper_std[:, :f_index]
+				data_op_upper_nb = data_op_upper_nb[:, :f_index]
+				data_op_lower_avg = data_op_lower_avg[:, :f_index + 1]
+				data_op_lower_std = data_op_lower_std[:, :f_index]
+				data_op_lower_nb = data_op_lower_nb[:, :f_index]
+			break
 		
-		#get file content
+		#get data (checking the file against the first one if it wasn't indexed beforehand)
 		filename = args.xvgfilenames[f_index]
-		with open(filename) as f:
-			lines = f.readlines()
-		
-		#determine legends and nb of lines to skip
-		tmp_nb_rows_to_skip = 0
-		for l_index in range(0,len(lines)):
-			line = lines[l_index]
-			if line[0] in args.comments:
-				tmp_nb_rows_to_skip += 1
-				if "weight" in line:
-					if "-> weight = " in line:
-						weights[f_index] = float(line.split("-> weight = ")[1])
-						if weights[f_index] < 0:
-							print "\nError: the weight in file " + str(filename) + " should be a positive number."
-							print " -> " + str(line)
-							sys.exit(1)
-					else:
-						print "\nWarning: keyword 'weight' found in the comments of file " + str(filename) + ", but weight not read in as the format '-> weight = ' wasn't found."
-		
-		#get data
-		tmp_data = np.loadtxt(filename, skiprows = tmp_nb_rows_to_skip)
-		
-		#check that each file has the same number of data rows
-		if f_index == 0:
-			nb_rows = np.shape(tmp_data)[0]
-			data_op_upper_avg = np.zeros((nb_rows, len(args.xvgfilenames) + 1))			#distance, avg op upper for each file
-			data_op_upper_std = np.zeros((nb_rows, len(args.xvgfilenames)))				#std op upper for each file
-			data_op_upper_nb = np.zeros((nb_rows, len(args.xvgfilenames)))				#nb op upper for each file
-			data_op_lower_avg = np.zeros((nb_rows, len(args.xvgfilenames) + 1))			#distance, avg op upper for each file
-			data_op_lower_std = np.zeros((nb_rows, len(args.xvgfilenames)))				#std op upper for each file
-			data_op_lower_nb = np.zeros((nb_rows, len(args.xvgfilenames)))				#nb op upper for each file
+		if tmp_frames is not None:
+			tmp_data = np.concatenate([common.parse_block(xvg_contents.next(), filename, frame_rows, nb_cols, usecols) for n in tmp_frames])
 		else:
-			if np.shape(tmp_data)[0] != nb_rows:
-				print "Error: file " + str(filename) + " has " + str(np.shape(tmp_data)[0]) + " data rows, whereas file " + str(args.xvgfilenames[0]) + " has " + str(nb_rows) + " data rows."
-				sys.exit(1)
-		#check that each file has the same number of columns
-		if f_index == 0:
-			nb_cols = np.shape(tmp_data)[1]
-		else:
-			if np.shape(tmp_data)[1] != nb_cols:
-				print "Error: file " + str(filename) + " has " + str(np.shape(tmp_data)[1]) + " data columns, whereas file " + str(args.xvgfilenames[0]) + " has " + str(nb_cols) + " data columns."
-				sys.exit(1)
+			content, tmp_entry = xvg_contents.next()
+			if tmp_entry is None:
+				tmp_entry = xvg_index[f_index]
+			else:
+				add_entry(f_index, tmp_entry)
+				if f_index == 0:
+					allocate_data()
+			if args.mmap:
+				tmp_data = common.mmap_xvg(content, filename, tmp_entry, usecols)
+			else:
+				tmp_data = np.loadtxt(content.splitlines(True), skiprows = tmp_entry["header"], usecols = usecols, ndmin = 2)
+		
+		#check that the file hasn't changed since it was indexed
+		if np.shape(tmp_data)[0] != nb_rows:
+			print "\nError: file " + str(filename) + " has " + str(np.shape(tmp_data)[0]) + " data rows, whereas " + str(nb_rows) + " were found when indexing it."
+			sys.exit(1)
 		#check that each file has the same first column
 		if f_index == 0:
-			data_op_upper_avg[:,0] = tmp_data[:,0]
-			data_op_lower_avg[:,0] = tmp_data[:,0]
+			distances = np.copy(tmp_data[:,0])
+			if not args.sparse:
+				data_op_upper_avg[:,0] = tmp_data[:,0]
+				data_op_lower_avg[:,0] = tmp_data[:,0]
 		else:
-			if not np.array_equal(tmp_data[:,0],data_op_upper_avg[:,0]):
+			if not np.array_equal(tmp_data[:,0],distances):
 				print "\nError: the first column of file " + str(filename) + " is different than that of " + str(args.xvgfilenames[0]) + "."
 				sys.exit(1)
 		
 		#store data
-		if args.membrane == "AM_zCter":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,3]
-			data_op_upper_std[:, f_index] = tmp_data[:,6]
-			data_op_upper_nb[:, f_index] = tmp_data[:,9]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,13]
-			data_op_lower_std[:, f_index] = tmp_data[:,17]
-			data_op_lower_nb[:, f_index] = tmp_data[:,21]
-		elif args.membrane == "AM_zNter":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,15]
-			data_op_upper_std[:, f_index] = tmp_data[:,18]
-			data_op_upper_nb[:, f_index] = tmp_data[:,21]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,4]
-			data_op_lower_std[:, f_index] = tmp_data[:,8]
-			data_op_lower_nb[:, f_index] = tmp_data[:,12]
-		elif args.membrane == "SMa":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,16]
-			data_op_upper_std[:, f_index] = tmp_data[:,20]
-			data_op_upper_nb[:, f_index] = tmp_data[:,24]
+		if args.sparse:
+			#only keep the rows between the first and last rows with data of each leaflet
+			for leaflet, tmp_cols in [["upper", [1,2,3]], ["lower", [4,5,6]]]:
+				tmp_start, tmp_stop = common.valid_range(~(np.isnan(tmp_data[:,tmp_cols[0]]) & (tmp_data[:,tmp_cols[2]] == 0)))
+				data_op_sparse[leaflet].append([tmp_start, tmp_data[tmp_start:tmp_stop, tmp_cols].astype(data_dtype)])
+		else:
+			data_op_upper_avg[:, f_index + 1] = tmp_data[:,1]
+			data_op_upper_std[:, f_index] = tmp_data[:,2]
+			data_op_upper_nb[:, f_index] = tmp_data[:,3]
 			data_op_lower_avg[:, f_index + 1] = tmp_data[:,4]
-			data_op_lower_std[:, f_index] = tmp_data[:,8]
-			data_op_lower_nb[:, f_index] = tmp_data[:,12]
-		elif args.membrane == "SMz":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,12]
-			data_op_upper_std[:, f_index] = tmp_data[:,15]
-			data_op_upper_nb[:, f_index] = tmp_data[:,18]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,3]
-			data_op_lower_std[:, f_index] = tmp_data[:,6]
-			data_op_lower_nb[:, f_index] = tmp_data[:,9]
-		elif args.membrane == "POPC":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,8]
-			data_op_upper_std[:, f_index] = tmp_data[:,8]
-			data_op_upper_nb[:, f_index] = tmp_data[:,12]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,2]
-			data_op_lower_std[:, f_index] = tmp_data[:,4]
+			data_op_lower_std[:, f_index] = tmp_data[:,5]
 			data_op_lower_nb[:, f_index] = tmp_data[:,6]
+		
+		if args.checkpoint > 0 and (f_index + 1) % args.checkpoint == 0 and f_index + 1 < len(args.xvgfilenames):
+			accumulate_checkpoint(f_index + 1)
+			write_checkpoint(f_index + 1)
+		
+		if tmp_frames is None:
+			common.progress_update(tmp_progress, f_index + 1, tmp_entry["size"])
+		else:
+			common.progress_update(tmp_progress, f_index + 1, sum([xvg_index[f_index]["frames"][n][1] for n in tmp_frames]))
+	return
+
+def merge_stats():
+	
+	global nb_rows
+	global weights
+	global distances
+	global stats
+	
+	#merge the partial results in the order of their first file, whatever their order
+	tmp_partials = []
+	for filename in args.xvgfilenames:
+		tmp_partial = dict(np.load(filename))
+		if str(tmp_partial["variant"]) != "bienayme":
+			print "\nError: file " + str(filename) + " wasn't written by xvg_average_op with --partial."
+			sys.exit(1)
+		if args.membrane != "auto" and list(tmp_partial["columns"]) != [0] + [layouts[args.membrane][series] for series in layout_series]:
+			print "\nError: file " + str(filename) + " was written for membrane " + str(tmp_partial["membrane"]) + ", whose columns are different than those of membrane " + str(args.membrane) + "."
+			sys.exit(1)
+		if len(tmp_partials) > 0 and list(tmp_partial["columns"]) != list(tmp_partials[0][2]["columns"]):
+			print "\nError: the columns used for file " + str(filename) + " are different than those used for file " + str(tmp_partials[0][1]) + "."
+			sys.exit(1)
+		tmp_partials.append([str(tmp_partial["filenames"][0]), filename, tmp_partial])
+	tmp_partials.sort()
+	
+	tmp_filenames = []
+	tmp_weights = []
+	tmp_progress = common.progress_init(args, "merging partial result", len(tmp_partials))
+	for p_index in range(0,len(tmp_partials)):
+		filename, tmp_partial = tmp_partials[p_index][1:]
+		if p_index == 0:
+			distances = tmp_partial["distances"]
+			nb_rows = len(distances)
+			stats = {}
+			for key in tmp_partial:
+				if key not in ["variant", "membrane", "columns", "filenames", "weights", "distances"]:
+					stats[key] = np.copy(tmp_partial[key])
+		else:
+			if not np.array_equal(tmp_partial["distances"], distances):
+				print "\nError: the first column of the files of " + str(filename) + " is different than that of the files of " + str(tmp_partials[0][1]) + "."
+				sys.exit(1)
+			for key in stats:
+				stats[key] += tmp_partial[key]
+		tmp_filenames += [str(f) for f in tmp_partial["filenames"]]
+		tmp_weights.append(tmp_partial["weights"])
+		common.progress_update(tmp_progress, p_index + 1, os.path.getsize(filename))
+	
+	#check that no file was used in several partial results
+	for f in tmp_filenames:
+		if tmp_filenames.count(f) > 1:
+			print "\nError: file " + str(f) + " was used in several partial results."
+			sys.exit(1)
+	
+	#the average is then calculated as if all the files had been specified
+	args.xvgfilenames = tmp_filenames
+	weights = np.concatenate(tmp_weights)
+	
 	return
 
 #=========================================================================================
 # core functions
 #=========================================================================================
 
+def calculate_stats():
+
+	global stats
+	
+	#sums over the files needed to calculate the weighted avg and the bienayme std (sums
+	#from different sets of files can simply be added): those of the files read since the
+	#last checkpoint added to those of the checkpoint
+	stats = calculate_sums(checkpoint_done, len(args.xvgfilenames))
+	if checkpoint_done > 0:
+		for key in stats:
+			stats[key] = checkpoint_sums[key] + stats[key]
+	
+	return
+
+def calculate_sums(f_start, f_stop):
+	
+	#sums over the files f_start to f_stop - 1
+	tmp_stats = {}
+	if args.sparse:
+		return calculate_sums_sparse(f_start, f_stop)
+	if args.kernel == "numba":
+		tmp_sums = np.zeros((nb_rows, 8))
+		bienayme_kernel(data_op_upper_avg[:, f_start:f_stop + 1], data_op_upper_std[:, f_start:f_stop], data_op_upper_nb[:, f_start:f_stop], data_op_lower_avg[:, f_start:f_stop + 1], data_op_lower_std[:, f_start:f_stop], data_op_lower_nb[:, f_start:f_stop], weights[f_start:f_stop], tmp_sums)
+		for l_index, leaflet in enumerate(["upper", "lower"]):
+			for k_index, key in enumerate(["_sum", "_nb_files", "_var", "_nb"]):
+				tmp_stats[leaflet + key] = tmp_sums[:, 4 * l_index + k_index]
+		return tmp_stats
+	
+	for leaflet, tmp_avg, tmp_std, tmp_nb in [["upper", data_op_upper_avg[:, f_start + 1:f_stop + 1], data_op_upper_std[:, f_start:f_stop], data_op_upper_nb[:, f_start:f_stop]], ["lower", data_op_lower_avg[:, f_start + 1:f_stop + 1], data_op_lower_std[:, f_start:f_stop], data_op_lower_nb[:, f_start:f_stop]]]:
+		tmp_stats[leaflet + "_sum"], tmp_stats[leaflet + "_nb_files"], tmp_stats[leaflet + "_var"], tmp_stats[leaflet + "_nb"] = common.bienayme_sums(tmp_avg, tmp_std, tmp_nb, weights[f_start:f_stop])
+	
+	return tmp_stats
+
+def bienayme_row(tmp_avg, tmp_std, tmp_nb, tmp_weights, r, tmp_sums, c):
+	
+	#same sums as calculate_sums for row r of a leaflet, written in columns c to c + 3
+	#of tmp_sums (tmp_avg having the distances in its first column)
+	tmp_sum = 0.0
+	tmp_nb_files = 0.0
+	tmp_var = 0.0
+	tmp_nb_total = 0.0
+	for f in range(tmp_std.shape[1]):
+		tmp_w = tmp_weights[f]
+		tmp_a = np.float64(tmp_avg[r, f + 1])
+		if not np.isnan(tmp_a):
+			tmp_sum += tmp_a * tmp_w
+			tmp_nb_files += 1
+		tmp_n = np.float64(tmp_nb[r, f])
+		tmp_v = tmp_w**2 * np.float64(tmp_std[r, f])**2 * tmp_n
+		if not np.isnan(tmp_v):
+			tmp_var += tmp_v
+		if tmp_n != 0:
+			tmp_nb_total += tmp_n + 1
+	tmp_sums[r, c] = tmp_sum
+	tmp_sums[r, c + 1] = tmp_nb_files
+	tmp_sums[r, c + 2] = tmp_var
+	tmp_sums[r, c + 3] = tmp_nb_total
+	
+	return
+
+def bienayme_kernel(upper_avg, upper_std, upper_nb, lower_avg, lower_std, lower_nb, tmp_weights, tmp_sums):
+	
+	#fused kernel (compiled with numba): each value of the data is only read once
+	for r in range(upper_std.shape[0]):
+		bienayme_row(upper_avg, upper_std, upper_nb, tmp_weights, r, tmp_sums, 0)
+		bienayme_row(lower_avg, lower_std, lower_nb, tmp_weights, r, tmp_sums, 4)
+	
+	return
+
+#compile the kernel (when first called)
+if args.kernel == "numba":
+	bienayme_row = numba.njit(cache = True)(bienayme_row)
+	bienayme_kernel = numba.njit(cache = True)(bienayme_kernel)
+
+def calculate_sums_sparse(f_start, f_stop):
+	
+	#same sums, each file only being added to the rows it has data for (rows without data
+	#add nothing to any of the sums)
+	tmp_stats = {}
+	for leaflet in ["upper", "lower"]:
+		for key in ["_sum", "_nb_files", "_var", "_nb"]:
+			tmp_stats[leaflet + key] = np.zeros(nb_rows)
+		for f_index in range(f_start, f_stop):
+			tmp_start, tmp_packed = data_op_sparse[leaflet][f_index]
+			tmp_rows = slice(tmp_start, tmp_start + np.shape(tmp_packed)[0])
+			tmp_packed = np.asarray(tmp_packed, dtype = np.float64)
+			tmp_avg = tmp_packed[:,0]
+			tmp_std = tmp_packed[:,1]
+			tmp_nb = tmp_packed[:,2]
+			tmp_defined = ~np.isnan(tmp_avg)
+			tmp_stats[leaflet + "_sum"][tmp_rows] += np.where(tmp_defined, tmp_avg * weights[f_index], 0)
+			tmp_stats[leaflet + "_nb_files"][tmp_rows] += tmp_defined
+			tmp_var = weights[f_index]**2 * np.square(tmp_std) * tmp_nb
+			tmp_stats[leaflet + "_var"][tmp_rows] += np.where(np.isnan(tmp_var), 0, tmp_var)
+			tmp_stats[leaflet + "_nb"][tmp_rows] += np.where(tmp_nb != 0, tmp_nb + 1, 0)
+	
+	return tmp_stats
+
 def calculate_avg():													#DONE
 
 	global avg_op_upper_avg
@@ -234,57 +883,184 @@ def calculate_avg():													#DONE
 	avg_op_lower_std = np.zeros((nb_rows, 1))
 
 	#distances
-	avg_op_upper_avg[:,0] = data_op_upper_avg[:,0]
-	avg_op_lower_avg[:,0] = data_op_lower_avg[:,0]
-
-	#calculate weighted average taking into account "nan"
-	#----------------------------------------------------
-	avg_op_upper_avg[:,1] =  scipy.stats.nanmean(data_op_upper_avg[:,1:] * weights * len(args.xvgfilenames) / float(np.sum(weights)) , axis = 1)
-	avg_op_lower_avg[:,1] =  scipy.stats.nanmean(data_op_lower_avg[:,1:] * weights * len(args.xvgfilenames) / float(np.sum(weights)) , axis = 1)
-
-	#calculate unbiased weighted std dev taking into account "nan"
-	#-------------------------------------------------------------
-	#from Bienayme formula
-	# var(Xavg) = 1/(sum(wi))**2 * sum(wi**2 * var(Xi))
-		
-	#calculate total number of points
-	tmp_nb_total_upper = np.copy(data_op_upper_nb)
-	tmp_nb_total_upper[tmp_nb_total_upper != 0] += 1
-	tmp_nb_total_upper = np.sum(tmp_nb_total_upper, axis = 1)
-	tmp_nb_total_upper -= 1
-	tmp_nb_total_upper[tmp_nb_total_upper == 0] = 1
-	tmp_nb_total_upper[tmp_nb_total_upper == -1] = 1
-	
-	#calculate total number of points
-	tmp_nb_total_lower = np.copy(data_op_lower_nb)
-	tmp_nb_total_lower[tmp_nb_total_lower != 0] += 1
-	tmp_nb_total_lower = np.sum(tmp_nb_total_lower, axis = 1)
-	tmp_nb_total_lower -= 1
-	tmp_nb_total_lower[tmp_nb_total_lower == 0] = 1
-	tmp_nb_total_lower[tmp_nb_total_lower == -1] = 1
-	
-	#apply bienayme formula
-	avg_op_upper_std[:,0] = np.sqrt(np.nansum(weights**2 * data_op_upper_std**2 * data_op_upper_nb, axis = 1) / (np.sum(weights)**2 * tmp_nb_total_upper))
-	avg_op_lower_std[:,0] = np.sqrt(np.nansum(weights**2 * data_op_lower_std**2 * data_op_lower_nb, axis = 1) / (np.sum(weights)**2 * tmp_nb_total_lower))
+	avg_op_upper_avg[:,0] = distances
+	avg_op_lower_avg[:,0] = distances
+
+	#calculate weighted average and unbiased weighted std dev taking into account "nan"
+	#----------------------------------------------------------------------------------
+	avg_op_upper_avg[:,1], avg_op_upper_std[:,0] = common.bienayme_avg_std(stats["upper_sum"], stats["upper_nb_files"], stats["upper_var"], stats["upper_nb"], len(args.xvgfilenames), np.sum(weights))
+	avg_op_lower_avg[:,1], avg_op_lower_std[:,0] = common.bienayme_avg_std(stats["lower_sum"], stats["lower_nb_files"], stats["lower_var"], stats["lower_nb"], len(args.xvgfilenames), np.sum(weights))
+
+	#robust estimators of the avg (the std is still calculated with the Bienayme formula)
+	if args.estimator != "mean":
+		avg_op_upper_avg[:,1] = common.calculate_estimator(data_op_upper_avg[:,1:], weights, args.estimator, args.trim)
+		avg_op_lower_avg[:,1] = common.calculate_estimator(data_op_lower_avg[:,1:], weights, args.estimator, args.trim)
 		
 	return
 
+def calculate_diagnostics():
+	
+	global rms_upper
+	global rms_lower
+	global outliers
+	
+	#rms deviation of each file from the average
+	rms_upper = np.sqrt(scipy.stats.nanmean((data_op_upper_avg[:,1:] - avg_op_upper_avg[:,1:2])**2, axis = 0))
+	rms_lower = np.sqrt(scipy.stats.nanmean((data_op_lower_avg[:,1:] - avg_op_lower_avg[:,1:2])**2, axis = 0))
+	
+	#outliers: files whose rms deviation is too far above the median (robust z score)
+	outliers = np.zeros(len(args.xvgfilenames), dtype = bool)
+	for tmp_rms in [rms_upper, rms_lower]:
+		tmp_median = scipy.stats.nanmedian(tmp_rms)
+		tmp_mad = 1.4826 * scipy.stats.nanmedian(np.abs(tmp_rms - tmp_median))
+		with np.errstate(invalid = 'ignore'):
+			outliers |= tmp_rms > tmp_median + args.outlier * tmp_mad
+	
+	return
+
+def average_frames():
+	
+	global nb_rows
+	
+	#the rows of a batch of frames are averaged as those of a single file, each batch
+	#being written before the next one is read
+	for frame_start in range(0, nb_frames, args.frame_batch):
+		#stop between two batches if the run is interrupted
+		if common.cancel_requested:
+			print "\n\nInterrupted: only the first " + str(frame_start) + " frames were averaged (see file '" + args.output_file + ".xvg')."
+			sys.exit(1)
+		tmp_frames = range(frame_start, min(frame_start + args.frame_batch, nb_frames))
+		nb_rows = len(tmp_frames) * frame_rows
+		load_xvg(tmp_frames)
+		calculate_stats()
+		calculate_avg()
+		write_xvg(tmp_frames)
+	
+	return
+
 #=========================================================================================
 # outputs
 #=========================================================================================
 
-def write_xvg():														#DONE
+def write_coverage():
 
-	#open files
-	filename_xvg = os.getcwd() + '/' + str(args.output_file) + '.xvg'
+	#nb of files with data for each row
+	filename_xvg = os.getcwd() + '/' + str(args.output_file) + '_coverage.xvg'
 	output_xvg = open(filename_xvg, 'w')
+	output_xvg.write("# [coverage xvg - written by xvg_average_op v" + str(version_nb) + "]\n")
+	output_xvg.write("@ title \"Nb of files with data\"\n")
+	output_xvg.write("@ xaxis label \"distance from cluster z axis (Angstrom)\"\n")
+	output_xvg.write("@ yaxis label \"nb of files\"\n")
+	output_xvg.write("@ autoscale ONREAD xaxes\n")
+	output_xvg.write("@ TYPE XY\n")
+	output_xvg.write("@ legend on\n")
+	output_xvg.write("@ legend length 2\n")
+	output_xvg.write("@ s0 legend \"upper\"\n")
+	output_xvg.write("@ s1 legend \"lower\"\n")
+	for r in range(0, nb_rows):
+		output_xvg.write(str(distances[r]) + "	" + str(int(stats["upper_nb_files"][r])) + "	" + str(int(stats["lower_nb_files"][r])) + "\n")
+	output_xvg.close()
+	
+	return
+
+def write_diagnostics():
+
+	filename_txt = os.getcwd() + '/' + str(args.output_file) + '_files.txt'
+	output_txt = open(filename_txt, 'w')
+	output_txt.write("# [per file diagnostics - written by xvg_average_op v" + str(version_nb) + "]\n")
+	output_txt.write("# file	weight	upper rms deviation	lower rms deviation	outlier\n")
+	for f_index in range(0, len(args.xvgfilenames)):
+		output_txt.write(str(args.xvgfilenames[f_index]) + "	" + str(weights[f_index]) + "	" + "{:.6e}".format(rms_upper[f_index]) + "	" + "{:.6e}".format(rms_lower[f_index]) + "	" + str(int(outliers[f_index])) + "\n")
+	output_txt.close()
+	
+	return
+
+def write_summary():
+
+	tmp_summary = {}
+	tmp_summary["script"] = "xvg_average_op v" + str(version_nb)
+	tmp_summary["output"] = os.getcwd() + '/' + str(args.output_file) + '.xvg'
+	tmp_summary["options"] = dict(vars(args))
+	tmp_summary["files"] = list(args.xvgfilenames)
+	tmp_summary["weights"] = list(weights)
+	tmp_summary["nb rows"] = nb_rows
+	tmp_summary["nb rows with data"] = {"upper": int(np.sum(stats["upper_nb_files"] > 0)), "lower": int(np.sum(stats["lower_nb_files"] > 0))}
+	if args.diagnostics:
+		tmp_summary["outliers"] = [args.xvgfilenames[f_index] for f_index in np.where(outliers)[0]]
+	tmp_summary["duration (s)"] = time.time() - time_start
+	with open(os.getcwd() + '/' + str(args.output_file) + '_summary.json', 'w') as f:
+		json.dump(tmp_summary, f, indent = 1, sort_keys = True)
+	
+	return
+
+def write_summary_cached(tmp_dir):
+	
+	#update the summary copied from the cache with what's specific to this run
+	tmp_filename = os.getcwd() + '/' + str(args.output_file) + '_summary.json'
+	with open(tmp_filename) as f:
+		tmp_summary = json.load(f)
+	tmp_summary["output"] = os.getcwd() + '/' + str(args.output_file) + '.xvg'
+	tmp_summary["options"] = dict(vars(args))
+	tmp_summary["cached"] = tmp_dir
+	tmp_summary["duration (s)"] = time.time() - time_start
+	with open(tmp_filename, 'w') as f:
+		json.dump(tmp_summary, f, indent = 1, sort_keys = True)
+	
+	return
+
+def write_interrupted():
 	
+	#average and sums over the files read, and list of the files left (as a --file_list)
+	args.output_file = str(args.output_file) + "_interrupted"
+	calculate_stats()
+	write_stats()
+	if not args.partial:
+		calculate_avg()
+		write_xvg()
+	with open(os.getcwd() + '/' + str(args.output_file) + '_remaining.txt', 'w') as f:
+		f.write("\n".join(files_remaining) + "\n")
+	
+	return
+
+def write_stats():
+
+	#sums over the files, along with what's needed to check and merge them
+	filename_npz = os.getcwd() + '/' + str(args.output_file) + '.npz'
+	np.savez(filename_npz, variant = "bienayme", membrane = args.membrane, columns = np.array(usecols), filenames = np.array(args.xvgfilenames), weights = weights, distances = distances, **stats)
+	
+	return
+
+def write_xvg(tmp_frames = None):										#DONE
+
+	#open files (the frames after the first batch are appended)
+	filename_xvg = os.getcwd() + '/' + str(args.output_file) + '.xvg'
+	if tmp_frames is not None and tmp_frames[0] > 0:
+		output_xvg = open(filename_xvg, 'a')
+	else:
+		output_xvg = open(filename_xvg, 'w')
+		write_xvg_header(output_xvg)
+	
+	#data
+	for r in range(0, nb_rows):
+		if tmp_frames is not None and r % frame_rows == 0:
+			output_xvg.write("# frame " + str(tmp_frames[r / frame_rows] + 1) + "\n")
+		results = str(avg_op_upper_avg[r,0])
+		results += "	" + "{:.6e}".format(avg_op_upper_avg[r,1]) + "	" + "{:.6e}".format(avg_op_upper_std[r,0]) + "	" + "{:.6e}".format(avg_op_lower_avg[r,1]) + "	" + "{:.6e}".format(avg_op_lower_std[r,0])
+		output_xvg.write(results + "\n")		
+	output_xvg.close()	
+	
+	return
+
+def write_xvg_header(output_xvg):
+
 	#general header
 	output_xvg.write("# [average xvg - written by xvg_average_op v" + str(version_nb) + "]\n")
 	tmp_files = ""
 	for f in args.xvgfilenames:
 		tmp_files += "," + str(f)
 	output_xvg.write("# - files: " + str(tmp_files[1:]) + "\n")
+	if args.frames:
+		output_xvg.write("# - frames: " + str(nb_frames) + "\n")
 	if np.sum(weights) > len(args.xvgfilenames):
 		output_xvg.write("# -> weight = " + str(np.sum(weights)) + "\n")
 	
@@ -305,29 +1081,119 @@ def write_xvg():														#DONE
 	output_xvg.write("@ s2 legend \"lower (avg)\"\n")
 	output_xvg.write("@ s3 legend \"lower (std)\"\n")
 	
-	#data
-	for r in range(0, nb_rows):
-		results = str(avg_op_upper_avg[r,0])
-		results += "	" + "{:.6e}".format(avg_op_upper_avg[r,1]) + "	" + "{:.6e}".format(avg_op_upper_std[r,0]) + "	" + "{:.6e}".format(avg_op_lower_avg[r,1]) + "	" + "{:.6e}".format(avg_op_lower_std[r,0])
-		output_xvg.write(results + "\n")		
-	output_xvg.close()	
-	
 	return
 
 ##########################################################################################
 # MAIN
 ##########################################################################################
 
-print "\nReading files..."
-load_xvg()
+time_start = time.time()
+
+#checkpoints of this run (only valid for the same files, options and layouts)
+checkpoint_file = os.getcwd() + '/' + str(args.output_file) + '.ckpt.npz'
+if args.checkpoint > 0 or args.resume:
+	checkpoint_key = common.cache_key(args, parser.prog, version_nb, __file__, layouts)
+
+#files whose sums are in the last checkpoint, and ends of the chunk files holding their
+#data (only written if it's needed for the outputs)
+checkpoint_done = 0
+checkpoint_sums = None
+checkpoint_chunks = []
+checkpoint_data = args.estimator != "mean" or args.diagnostics
 
-print "\n\nWriting average file..."
-calculate_avg()
-write_xvg()
+#stop cleanly on SIGINT and SIGTERM
+signal.signal(signal.SIGINT, common.request_cancel)
+signal.signal(signal.SIGTERM, common.request_cancel)
+
+#index of the files, built beforehand with --index and --frames (the frames of each file
+#being needed to read them), otherwise as each file is read
+xvg_index = None
+nb_rows = None
+nb_cols = None
+first_file = None
+usecols = None
+weights = np.ones(len(args.xvgfilenames))
+
+#look for the result of an identical previous run
+use_cache = not args.no_cache and not args.partial
+cached = False
+if use_cache:
+	cache_key = common.cache_key(args, parser.prog, version_nb, __file__, layouts)
+	cached = common.cache_fetch(args, cache_key)
+
+if cached:
+	if os.path.isfile(os.path.join(args.cache_dir, cache_key, "result_summary.json")):
+		write_summary_cached(os.path.join(args.cache_dir, cache_key))
+	print "\nResult found in cache: the outputs were copied from " + os.path.join(args.cache_dir, cache_key) + " (use --no-cache to calculate them again)."
+elif args.frames:
+	print "\nIndexing files..."
+	index_xvg()
+	
+	print "\n\nReading and averaging frames..."
+	average_frames()
+	if use_cache:
+		common.check_cancel("caching the result")
+		common.cache_store(args, cache_key, [".xvg"])
+else:
+	if args.merge:
+		print "\nReading partial results..."
+		merge_stats()
+	else:
+		if args.index != "none":
+			print "\nIndexing files..."
+			index_xvg()
+			print ""
+		
+		print "\nReading files..."
+		load_xvg()
+		if len(files_remaining) > 0:
+			print "\n\nInterrupted: writing the results of the " + str(len(args.xvgfilenames)) + " files read..."
+			write_interrupted()
+			print "\nCheck results in files '" + args.output_file + ".npz' and '" + args.output_file + "_remaining.txt' (files left)."
+			print ""
+			sys.exit(1)
+		common.check_cancel("calculating the sums")
+		calculate_stats()
+	
+	if args.partial:
+		common.check_cancel("writing the partial results")
+		print "\n\nWriting partial results..."
+		write_stats()
+	else:
+		common.check_cancel("writing the average file")
+		print "\n\nWriting average file..."
+		calculate_avg()
+		write_xvg()
+		output_suffixes = [".xvg"]
+		if args.coverage:
+			common.check_cancel("writing the coverage")
+			write_coverage()
+			output_suffixes.append("_coverage.xvg")
+		if args.diagnostics:
+			common.check_cancel("calculating the diagnostics")
+			calculate_diagnostics()
+			write_diagnostics()
+			output_suffixes.append("_files.txt")
+		if args.summary:
+			common.check_cancel("writing the summary")
+			write_summary()
+			output_suffixes.append("_summary.json")
+		if use_cache:
+			common.check_cancel("caching the result")
+			common.cache_store(args, cache_key, output_suffixes)
 
 #=========================================================================================
 # exit
 #=========================================================================================
-print "\nFinished successfully! Check result in file '" + args.output_file + ".xvg'."
+if args.checkpoint > 0 or args.resume:
+	remove_checkpoint()
+if common.cancel_requested:
+	print "\n\nInterrupted too late to stop the run: the outputs were all written."
+	print ""
+	sys.exit(1)
+if args.partial:
+	print "\nFinished successfully! Check result in file '" + args.output_file + ".npz'."
+else:
+	print "\nFinished successfully! Check result in file '" + args.output_file + ".xvg'."
 print ""
 sys.exit(0)
@@ -0,0 +1,447 @@
+#generic python modules
+import argparse
+import sys, os
+import os.path
+import json
+import signal
+import socket
+import SocketServer
+import threading
+import time
+from collections import OrderedDict
+
+##########################################################################################
+# RETRIEVE USER INPUTS
+##########################################################################################
+
+#=========================================================================================
+# create parser
+#=========================================================================================
+version_nb = "0.0.1"
+parser = argparse.ArgumentParser(prog = 'xvg_average_op_server', usage='', add_help = False, formatter_class = argparse.RawDescriptionHelpFormatter, description =\
+'''
+**********************************************
+v''' + version_nb + '''
+author: Jean Helie (jean.helie@bioch.ox.ac.uk)
+git: https://github.com/jhelie/xvg_average_op
+**********************************************
+
+[ DESCRIPTION ]
+
+This script runs a server which answers averaging requests on a local Unix socket.
+
+The averages are the same as those of xvg_average_op (std calculated with the Bienayme
+formula) and xvg_average_op_simple (avg and std treated as metrics) but the files are
+only parsed once: their content is kept in memory (up to --cache files, the least
+recently used ones being dropped first) and re-read only if they've been modified. The
+calculations are those of xvg_average_op_common.py, shared with these scripts, and the
+files are sorted by name for std 'simple' as xvg_average_op_simple does.
+
+Each connection is answered in its own thread, so a slow or idle client doesn't hold
+up the others: a connection which hasn't sent its request within --timeout seconds is
+answered with an error and closed.
+
+[ REQUESTS ]
+
+Each connection sends one request as a single line of JSON and receives one line of
+JSON back, e.g.:
+
+ {"files": ["/data/r1.xvg","/data/r2.xvg"], "membrane": "SMa", "std": "bienayme", "output": "/data/op_avg"}
+
+ -files		: xvg file(s) to average
+ -membrane	: 'AM_zCter','AM_zNter','SMa','SMz','POPC' or a membrane of --layouts
+ -std		: 'bienayme' (default) or 'simple'
+ -output	: name of the output xvg file to write (optional, if not specified
+		  the averaged columns are returned in the 'data' field of the answer)
+
+The files and output should be absolute paths: the server and its clients don't run in
+the same directory, so relative paths are rejected.
+
+The answer is {"status": "ok", ...} or {"status": "error", "message": ...}.
+Two other requests are understood: {"command": "stats"} and {"command": "shutdown"}.
+
+From a shell a request can be sent with e.g.:
+ echo '{"files": ["/data/r1.xvg","/data/r2.xvg"], "membrane": "SMa"}' | socat - UNIX-CONNECT:xvg_average_op.sock
+
+[ USAGE ]
+
+Option	      Default  	Description
+-----------------------------------------------------
+--socket	xvg_average_op.sock
+			: Unix socket to listen on
+--cache		1000	: max number of files kept in memory
+--timeout	10	: seconds to wait for the request of each connection
+--comments	@,#	: lines starting with these characters will be considered as comment
+--layouts	none	: file defining the columns of other membranes (same format as
+			  xvg_average_op_layouts.ini, with the nb columns)
+
+Other options
+-----------------------------------------------------
+--version		: show version number and exit
+-h, --help		: show this menu and exit
+
+''')
+
+#options
+parser.add_argument('--socket', nargs=1, dest='socket', default=["xvg_average_op.sock"], help=argparse.SUPPRESS)
+parser.add_argument('--cache', nargs=1, dest='cache_size', default=[1000], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--timeout', nargs=1, dest='timeout', default=[10], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--comments', nargs=1, dest='comments', default=['@,#'], help=argparse.SUPPRESS)
+parser.add_argument('--layouts', nargs=1, dest='layouts', default=['none'], help=argparse.SUPPRESS)
+
+#other options
+parser.add_argument('--version', action='version', version='%(prog)s v' + version_nb, help=argparse.SUPPRESS)
+parser.add_argument('-h','--help', action='help', help=argparse.SUPPRESS)
+
+#=========================================================================================
+# store inputs
+#=========================================================================================
+
+args = parser.parse_args()
+args.socket = os.path.abspath(args.socket[0])
+args.cache_size = args.cache_size[0]
+args.timeout = args.timeout[0]
+args.comments = args.comments[0].split(',')
+args.layouts = args.layouts[0]
+
+#=========================================================================================
+# import modules (doing it now otherwise might crash before we can display the help menu!)
+#=========================================================================================
+
+#generic science modules
+try:
+	import numpy as np
+except:
+	print "Error: you need to install the np module."
+	sys.exit(1)
+
+#code shared by the xvg_average_op scripts
+try:
+	import xvg_average_op_common as common
+except ImportError:
+	print "Error: xvg_average_op_common.py should be in the same directory as " + str(parser.prog) + ".py."
+	sys.exit(1)
+
+#=======================================================================
+# sanity check
+#=======================================================================
+
+if args.cache_size < 1:
+	print "Error: --cache should be at least 1."
+	sys.exit(1)
+
+if args.timeout <= 0:
+	print "Error: --timeout should be greater than 0."
+	sys.exit(1)
+
+if os.path.exists(args.socket):
+	print "Error: " + str(args.socket) + " already exists (remove it if no server is running)."
+	sys.exit(1)
+
+#=======================================================================
+# column layouts
+#=======================================================================
+
+#series read in the input files
+layout_series = ["upper avg", "upper std", "upper nb", "lower avg", "lower std", "lower nb"]
+
+#column of each series in the input files for each membrane: the layouts shipped in
+#xvg_average_op_layouts.ini, then those of the --layouts file (same format)
+tmp_layouts_files = [common.layouts_file]
+if args.layouts != "none":
+	tmp_layouts_files.append(args.layouts)
+layouts = {}
+for tmp_file in tmp_layouts_files:
+	try:
+		common.read_layouts(tmp_file, layout_series, layouts)
+	except ValueError, e:
+		print "Error: " + str(e)
+		sys.exit(1)
+
+##########################################################################################
+# FUNCTIONS DEFINITIONS
+##########################################################################################
+
+#=========================================================================================
+# data loading
+#=========================================================================================
+
+#files parsed (shared by the threads answering the requests)
+cache = OrderedDict()
+cache_hits = 0
+cache_misses = 0
+cache_lock = threading.Lock()
+
+def parse_xvg(filename):
+
+	#get file content
+	with open(filename) as f:
+		lines = f.readlines()
+
+	#determine weight and nb of lines to skip
+	weight = 1
+	tmp_nb_rows_to_skip = 0
+	for line in lines:
+		if line[0] in args.comments:
+			tmp_nb_rows_to_skip += 1
+			if "-> weight = " in line:
+				weight = float(line.split("-> weight = ")[1])
+				if weight < 0:
+					raise ValueError("the weight in file " + str(filename) + " should be a positive number.")
+
+	#get data
+	tmp_data = np.loadtxt(lines, skiprows = tmp_nb_rows_to_skip, ndmin = 2)
+
+	return weight, tmp_data
+
+def get_xvg(filename):
+
+	global cache_hits
+	global cache_misses
+
+	if not os.path.isfile(filename):
+		raise ValueError("file " + str(filename) + " not found.")
+
+	#use the cached content if the file hasn't changed since it was parsed
+	filename = os.path.abspath(filename)
+	stat = os.stat(filename)
+	with cache_lock:
+		if filename in cache:
+			tmp_stat, tmp_weight, tmp_data = cache.pop(filename)
+			if tmp_stat == (stat.st_mtime, stat.st_size):
+				cache[filename] = (tmp_stat, tmp_weight, tmp_data)
+				cache_hits += 1
+				return tmp_weight, tmp_data
+		cache_misses += 1
+
+	#otherwise parse it (outside of the lock, so that other requests can go on) and drop
+	#the least recently used files
+	tmp_weight, tmp_data = parse_xvg(filename)
+	with cache_lock:
+		cache[filename] = ((stat.st_mtime, stat.st_size), tmp_weight, tmp_data)
+		while len(cache) > args.cache_size:
+			cache.popitem(last = False)
+
+	return tmp_weight, tmp_data
+
+def stack_xvg(filenames, membrane):
+
+	nb_files = len(filenames)
+	weights = np.ones(nb_files)
+	tmp_cols = [layouts[membrane][series] for series in layout_series]
+
+	for f_index in range(0, nb_files):
+		weights[f_index], tmp_data = get_xvg(filenames[f_index])
+
+		#check that each file has the same rows and columns
+		if f_index == 0:
+			nb_rows, nb_cols = np.shape(tmp_data)
+			if nb_cols <= max(tmp_cols):
+				raise ValueError("file " + str(filenames[0]) + " has only " + str(nb_cols) + " data columns.")
+			distances = tmp_data[:,0]
+			data = np.zeros((6, nb_rows, nb_files))
+		else:
+			if np.shape(tmp_data)[0] != nb_rows:
+				raise ValueError("file " + str(filenames[f_index]) + " has " + str(np.shape(tmp_data)[0]) + " data rows, whereas file " + str(filenames[0]) + " has " + str(nb_rows) + " data rows.")
+			if np.shape(tmp_data)[1] != nb_cols:
+				raise ValueError("file " + str(filenames[f_index]) + " has " + str(np.shape(tmp_data)[1]) + " data columns, whereas file " + str(filenames[0]) + " has " + str(nb_cols) + " data columns.")
+			if not np.array_equal(tmp_data[:,0], distances):
+				raise ValueError("the first column of file " + str(filenames[f_index]) + " is different than that of " + str(filenames[0]) + ".")
+
+		#store data
+		data[:, :, f_index] = tmp_data[:, tmp_cols].T
+
+	return weights, distances, data
+
+#=========================================================================================
+# core functions
+#=========================================================================================
+
+def calculate_bienayme(weights, data):
+
+	#same sums and formula as xvg_average_op
+	results = []
+	for avg, std, nb in [data[0:3], data[3:6]]:
+		tmp_sum, tmp_nb_files, tmp_var, tmp_nb = common.bienayme_sums(avg, std, nb, weights)
+		results += common.bienayme_avg_std(tmp_sum, tmp_nb_files, tmp_var, tmp_nb, len(weights), np.sum(weights))
+
+	return results
+
+def calculate_simple(weights, data):
+
+	#same exact sums as xvg_average_op_simple (updated file by file)
+	results = {}
+	for name, tmp_data in [["upper avg", data[0]], ["upper std", data[1]], ["lower avg", data[3]], ["lower std", data[4]]]:
+		tmp_moments = common.moments_init(np.shape(tmp_data)[0])
+		for f_index in range(0, len(weights)):
+			common.moments_update(tmp_moments, tmp_data[:, f_index], weights[f_index])
+		results[name] = list(common.moments_avg_std(tmp_moments))
+
+	return results["upper avg"] + results["lower avg"] + results["upper std"] + results["lower std"]
+
+#=========================================================================================
+# outputs
+#=========================================================================================
+
+def write_xvg(filename_xvg, filenames, weights, std_mode, distances, results):
+
+	#open files
+	output_xvg = open(filename_xvg, 'w')
+
+	#general header
+	if std_mode == "simple":
+		output_xvg.write("# [average xvg - written by xvg_average_op_simple v" + str(version_nb) + "]\n")
+	else:
+		output_xvg.write("# [average xvg - written by xvg_average_op v" + str(version_nb) + "]\n")
+	output_xvg.write("# - files: " + ",".join(filenames) + "\n")
+	if np.sum(weights) > len(filenames):
+		output_xvg.write("# -> weight = " + str(np.sum(weights)) + "\n")
+
+	#xvg metadata
+	output_xvg.write("@ title \"Average xvg\"\n")
+	output_xvg.write("@ xaxis label \"distance from cluster z axis (Angstrom)\"\n")
+	output_xvg.write("@ yaxis label \"order parameter\"\n")
+	output_xvg.write("@ autoscale ONREAD xaxes\n")
+	output_xvg.write("@ TYPE XY\n")
+	output_xvg.write("@ view 0.15, 0.15, 0.95, 0.85\n")
+	output_xvg.write("@ legend on\n")
+	output_xvg.write("@ legend box on\n")
+	output_xvg.write("@ legend loctype view\n")
+	output_xvg.write("@ legend 0.98, 0.8\n")
+	if std_mode == "simple":
+		output_xvg.write("@ legend length 8\n")
+		output_xvg.write("@ s0 legend \"upper avg (avg)\"\n")
+		output_xvg.write("@ s1 legend \"upper avg (std)\"\n")
+		output_xvg.write("@ s2 legend \"lower avg (avg)\"\n")
+		output_xvg.write("@ s3 legend \"lower avg (std)\"\n")
+		output_xvg.write("@ s4 legend \"upper std (avg)\"\n")
+		output_xvg.write("@ s5 legend \"upper std (std)\"\n")
+		output_xvg.write("@ s6 legend \"lower std (avg)\"\n")
+		output_xvg.write("@ s7 legend \"lower std (std)\"\n")
+	else:
+		output_xvg.write("@ legend length 4\n")
+		output_xvg.write("@ s0 legend \"upper (avg)\"\n")
+		output_xvg.write("@ s1 legend \"upper (std)\"\n")
+		output_xvg.write("@ s2 legend \"lower (avg)\"\n")
+		output_xvg.write("@ s3 legend \"lower (std)\"\n")
+
+	#data
+	for r in range(0, len(distances)):
+		results_r = str(distances[r])
+		for tmp_col in results:
+			results_r += "	" + "{:.6e}".format(tmp_col[r])
+		output_xvg.write(results_r + "\n")
+	output_xvg.close()
+
+	return
+
+#=========================================================================================
+# requests
+#=========================================================================================
+
+stop_server = False
+
+def process_request(request):
+
+	global stop_server
+
+	#server commands
+	if "command" in request:
+		if request["command"] == "shutdown":
+			stop_server = True
+			return {"status": "ok"}
+		elif request["command"] == "stats":
+			with cache_lock:
+				return {"status": "ok", "cached files": len(cache), "cache size": args.cache_size, "hits": cache_hits, "misses": cache_misses}
+		else:
+			raise ValueError("unknown command '" + str(request["command"]) + "'.")
+
+	#averaging request
+	filenames = request.get("files", [])
+	membrane = request.get("membrane", "not specified")
+	std_mode = request.get("std", "bienayme")
+	if len(filenames) < 2:
+		raise ValueError("at least 2 data files should be specified.")
+	if membrane not in layouts:
+		raise ValueError("membrane should be one of " + ", ".join(sorted(layouts)) + ".")
+	if std_mode not in ["bienayme", "simple"]:
+		raise ValueError("std should be 'bienayme' or 'simple'.")
+	tmp_paths = list(filenames)
+	if "output" in request:
+		tmp_paths.append(request["output"])
+	for tmp_path in tmp_paths:
+		if not os.path.isabs(str(tmp_path)):
+			raise ValueError("path " + str(tmp_path) + " should be absolute (relative paths would be those of the directory the server was started from).")
+	if std_mode == "simple":
+		filenames = sorted(filenames)
+
+	weights, distances, data = stack_xvg(filenames, membrane)
+	if std_mode == "simple":
+		results = calculate_simple(weights, data)
+	else:
+		results = calculate_bienayme(weights, data)
+
+	if "output" in request:
+		filename_xvg = str(request["output"]) + '.xvg'
+		write_xvg(filename_xvg, filenames, weights, std_mode, distances, results)
+		return {"status": "ok", "output": filename_xvg}
+	else:
+		#nan isn't valid JSON: send them as null
+		data = np.column_stack([distances] + results)
+		data = [[None if np.isnan(x) else x for x in row] for row in data.tolist()]
+		return {"status": "ok", "data": data}
+
+class request_handler(SocketServer.StreamRequestHandler):
+
+	#timeout of the reads and writes on the connection
+	timeout = args.timeout
+
+	def handle(self):
+		try:
+			answer = process_request(json.loads(self.rfile.readline()))
+		except socket.timeout:
+			answer = {"status": "error", "message": "no request received within " + str(args.timeout) + " seconds."}
+		except Exception, e:
+			answer = {"status": "error", "message": str(e)}
+		try:
+			self.wfile.write(json.dumps(answer) + "\n")
+		except socket.error:
+			pass
+
+class threading_server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+	#answer each connection in its own thread (not waited for when stopping)
+	daemon_threads = True
+
+def stop_handler(signum, frame):
+	global stop_server
+	stop_server = True
+
+##########################################################################################
+# MAIN
+##########################################################################################
+
+server = threading_server(args.socket, request_handler)
+server.timeout = 1
+signal.signal(signal.SIGTERM, stop_handler)
+print "\nListening on " + str(args.socket) + "..."
+
+try:
+	while not stop_server:
+		server.handle_request()
+except KeyboardInterrupt:
+	pass
+
+#=========================================================================================
+# exit
+#=========================================================================================
+#let the requests being answered finish (for at most --timeout seconds)
+tmp_deadline = time.time() + args.timeout
+for tmp_thread in threading.enumerate():
+	if tmp_thread is not threading.current_thread():
+		tmp_thread.join(max(0, tmp_deadline - time.time()))
+server.server_close()
+os.remove(args.socket)
+print "\nFinished successfully! Server stopped."
+print ""
+sys.exit(0)
@@ -4,6 +4,10 @@ import operator
 from operator import itemgetter
 import sys, os, shutil
 import os.path
+import functools
+import json
+import time
+import signal
 
 ##########################################################################################
 # RETRIEVE USER INPUTS
@@ -33,14 +37,156 @@ the script may give out a warning 'return np.mean(x,axis)/factor', it's ok. it's
 scipy warning us that there were only nans on a row, the result will be a nan as we
 expect (see this thread: https://github.com/scipy/scipy/issues/2898).
 
+--precision 32 halves the memory used to store the data read in, which is only kept for
+the robust estimators and --diagnostics (see below): the avg and std of each file are
+then kept as float32, which still allows the 'nan' of empty rows. The sums are always
+accumulated exactly from the values as read, so with the default mean estimator
+nothing is stored and --precision has no effect. float32 storage introduces a relative
+error of at most ~6e-8 on each value stored, i.e. well below both the ~6 significant
+digits of the inputs and the '%.6e' format of the output.
+
+Each file is indexed (weight, nb of header lines, rows and columns) by the thread which
+reads it, so that it is only read once, and is checked against the first file before its
+data is parsed. With --index the files are indexed in a first pass (in the same pool of
+threads), so that an ensemble with inconsistent files is rejected before any data is
+parsed, and the index is kept in a json file so that only the files modified since the
+previous run are indexed again. The files are always indexed first with --frames.
+
+The files are read by --threads threads ahead of their parsing, as long as the files
+read and not parsed yet (including the one being parsed) total at most --prefetch MB, a
+larger file only being read once the previous ones are parsed. Reading the files thus
+takes about --prefetch MB of memory (or the size of the largest file, if larger), plus
+the list of lines of the file being parsed without --mmap, on top of the data stored.
+
+The avg of each row is by default the weighted mean over the files. Robust estimators,
+less sensitive to outlier files, can be used instead with --estimator: the weighted
+median, the weighted mean of the values between the --trim and 1 - --trim weighted
+quantiles ('trimmed') or the weighted mean after replacing the values beyond these
+quantiles by the quantiles themselves ('winsorized').
+
+The avg and std of each row are calculated in a single pass over the files, from sums
+over the files (of the weights, squared weights, weighted values and weighted squared
+values) updated with each file as it is read. These sums are exact: each product is
+split into float64 slices whose sums are exact, for up to ~4 million files. The result
+thus doesn't depend on the order of the files, the avg and std being each rounded once
+from the exact sums. Files are still read in alphabetical order, so that the list of
+files doesn't depend on their order on the command line. With the default 'mean'
+estimator the data of the files isn't kept in memory.
+
+The files can be averaged in several goes (e.g. on different nodes): with --partial the
+exact sums over the files specified (which are all the average depends on) are written
+to a .npz file, and with --merge the sums of the .npz files of several runs are added to
+give the average xvg, identical to that of a single run over all the files. Only the
+mean estimator can be used in this case.
+
+The columns read for each membrane are defined in xvg_average_op_layouts.ini (next to
+the scripts, with xvg_average_op_common.py), with a section per membrane and a line per
+series ('upper avg', 'upper std', 'lower avg' and 'lower std', the nb columns not being
+read). Other membranes can be added there or in a --layouts file with the same format:
+ [POPC]
+ upper avg = 8
+ upper std = 10
+ ...
+With --membrane auto the columns are found from the legends of the first file (the
+legend of 'upper avg' should be the only one containing 'upper' and 'avg', etc). Only
+the columns needed are parsed.
+
+For large files --mmap reduces the memory needed to parse them: the numbers are parsed
+by numpy directly from a memory map of the file, from the end of the header, rather
+than from a list of lines. The comment lines must all be at the top of the files.
+
+The results are cached: if the same files (same path, size and modification time) are
+averaged again with the same options and layouts and by the same version of the code
+(same source of the script and of xvg_average_op_common.py), the outputs of the previous
+run are simply copied, the output path and duration in the --summary being those of the
+new run. Only the --cache_size most recently used results are kept.
+
+The extra outputs are calculated from the data already in memory, without reading the
+files again. For --diagnostics the rms deviation of each file is calculated over the
+rows where both the file and the average are defined, for the upper and lower avg; a
+file is flagged as an outlier if either is more than --outlier times 1.4826 x the
+median absolute deviation above the median over the files.
+
+With --frames the files can hold a time series: blocks of data rows (one per frame, all
+with the same nb of rows) separated by comment lines, '&' lines or blank lines. Each
+frame is averaged over the files separately, --frame_batch frames at a time: the rows of
+these frames are processed together as a single table, and only these frames are held in
+memory whatever the nb of frames in the files. Each frame of the output is preceded by a
+'# frame' comment line. --frames can't be used with --partial, --merge or the extra
+outputs (--coverage, --diagnostics and --summary).
+
+With --sparse the sums of each series are only updated with the rows of each file
+between its first and last non 'nan' values: the time needed then depends on the nb of
+rows with data rather than on the total nb of rows of the files. It can only be used
+with the mean estimator and without --diagnostics (which need the data of all the rows).
+
+The progress is shown on the terminal (--progress tty) or written as structured lines
+('progress stage=reading_file done=10 total=100 ...', --progress log, e.g. for
+the logs of batch schedulers), in both cases at most every --progress_interval seconds,
+along with the nb of files and MB read per second and the estimated time left.
+
+If the script is interrupted (SIGINT or SIGTERM) while the files are read, it stops after
+the current file: the files read are averaged in op_avg_interrupted.xvg, their sums are
+written in op_avg_interrupted.npz (as with --partial) and the files left are listed in
+op_avg_interrupted_remaining.txt, so that the run can be completed (mean estimator only)
+by running the script with the other options of the interrupted run and:
+ --file_list op_avg_interrupted_remaining.txt --partial -o op_avg_remaining
+ -f op_avg_interrupted.npz op_avg_remaining.npz --merge
+With --frames it stops after the current batch of frames. Once the files are read (or
+with --merge) it stops before the next stage (calculating or writing each output), the
+outputs written so far being kept but not cached, and a signal received while the last
+output is written is reported: in all these cases the exit code is 1. A second signal
+stops the script straight away.
+
+With --checkpoint N the sums over the files read are saved in op_avg.ckpt.npz every N
+files (and when the script is interrupted), and with --resume a run started again with
+the same files and options continues from the last checkpoint rather than from the
+first file, the result being exactly the same as that of an uninterrupted run. The data
+itself is only kept for the robust estimators and --diagnostics: the data of the files
+read since the previous checkpoint is then also written in a new chunk file
+(op_avg.ckpt.0.npz, ...), so that each file is only written once. The checkpoint files
+are removed once the run is complete.
+
 [ USAGE ]
 
 Option	      Default  	Description                    
 -----------------------------------------------------
 -f			: xvg file(s)
+--file_list	none	: file listing xvg files, one per line (added to those of -f, e.g.
+			  for ensembles too large for a command line)
 -o		op_avg	: name of outptut file
---membrane		: 'AM_zCter','AM_zNter','SMa','SMz' or 'POPC'
+--membrane		: 'AM_zCter','AM_zNter','SMa','SMz','POPC', a membrane of the
+			  --layouts file or 'auto' (see NB above)
+--layouts	none	: file defining the columns of other membranes
 --comments	@,#	: lines starting with these characters will be considered as comment
+--precision	64	: storage precision of the data read in ('64' or '32', see NB above)
+--threads	4	: nb of threads reading (and indexing) the files ahead of their parsing
+--prefetch	64	: max size (MB) of the files read ahead and waiting to be parsed
+--mmap			: parse the files straight from memory maps (see NB above)
+--index		none	: json file where to keep the index of the files (see NB above)
+--sparse		: only keep and process the rows of each file with data (see NB above)
+--estimator	mean	: 'mean', 'median', 'trimmed' or 'winsorized' (see NB above)
+--trim		0.1	: fraction of the weight trimmed or winsorized at each end
+--partial		: write the sums needed to calculate the average in the file
+			  'op_avg.npz' instead of calculating the average (see NB above)
+--merge			: calculate the average from -f files written with --partial
+--cache_dir	~/.xvg_average_op
+			: directory where the results are cached (see NB above)
+--cache_size	100	: max nb of results kept in the cache
+--no-cache		: calculate the average even if it's in the cache
+--coverage		: also write the nb of files with data for each row (op_avg_coverage.xvg)
+--diagnostics		: also write the rms deviation of each file from the average and flag
+			  outliers (op_avg_files.txt, see NB above)
+--outlier	3	: nb of (MAD estimated) std dev above the median rms deviation from which
+			  a file is flagged as an outlier
+--summary		: also write a summary of the run (op_avg_summary.json)
+--frames		: average each frame of the files separately (see NB above)
+--frame_batch	10	: nb of frames read and averaged at once
+--progress	tty	: how to show the progress: 'tty', 'log' or 'none' (see NB above)
+--progress_interval	1
+			: min nb of seconds between two progress updates
+--checkpoint	0	: save what was read every N files (0: never, see NB above)
+--resume		: continue from the checkpoint of a previous run, if any
 
 Other options
 -----------------------------------------------------
@@ -50,10 +196,35 @@ Other options
 ''')
 
 #options
-parser.add_argument('-f', nargs='+', dest='xvgfilenames', help=argparse.SUPPRESS, required=True)
+parser.add_argument('-f', nargs='+', dest='xvgfilenames', default=[], help=argparse.SUPPRESS)
+parser.add_argument('--file_list', nargs=1, dest='file_list', default=['none'], help=argparse.SUPPRESS)
 parser.add_argument('-o', nargs=1, dest='output_file', default=["op_avg"], help=argparse.SUPPRESS)
-parser.add_argument('--membrane', dest='membrane', choices=['AM_zCter','AM_zNter','SMa','SMz','POPC'], default='not specified', help=argparse.SUPPRESS, required=True)
+parser.add_argument('--membrane', dest='membrane', default='not specified', help=argparse.SUPPRESS, required=True)
+parser.add_argument('--layouts', nargs=1, dest='layouts', default=['none'], help=argparse.SUPPRESS)
 parser.add_argument('--comments', nargs=1, dest='comments', default=['@,#'], help=argparse.SUPPRESS)
+parser.add_argument('--precision', dest='precision', choices=['64','32'], default='64', help=argparse.SUPPRESS)
+parser.add_argument('--threads', nargs=1, dest='threads', default=[4], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--prefetch', nargs=1, dest='prefetch', default=[64], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--mmap', dest='mmap', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--index', nargs=1, dest='index', default=['none'], help=argparse.SUPPRESS)
+parser.add_argument('--sparse', dest='sparse', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--estimator', dest='estimator', choices=['mean','median','trimmed','winsorized'], default='mean', help=argparse.SUPPRESS)
+parser.add_argument('--trim', nargs=1, dest='trim', default=[0.1], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--partial', dest='partial', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--merge', dest='merge', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--cache_dir', nargs=1, dest='cache_dir', default=['~/.xvg_average_op'], help=argparse.SUPPRESS)
+parser.add_argument('--cache_size', nargs=1, dest='cache_size', default=[100], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--no-cache', dest='no_cache', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--coverage', dest='coverage', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--diagnostics', dest='diagnostics', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--outlier', nargs=1, dest='outlier', default=[3], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--summary', dest='summary', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--frames', dest='frames', action='store_true', help=argparse.SUPPRESS)
+parser.add_argument('--frame_batch', nargs=1, dest='frame_batch', default=[10], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--progress', dest='progress', choices=['tty','log','none'], default='tty', help=argparse.SUPPRESS)
+parser.add_argument('--progress_interval', nargs=1, dest='progress_interval', default=[1], type=float, help=argparse.SUPPRESS)
+parser.add_argument('--checkpoint', nargs=1, dest='checkpoint', default=[0], type=int, help=argparse.SUPPRESS)
+parser.add_argument('--resume', dest='resume', action='store_true', help=argparse.SUPPRESS)
 
 #other options
 parser.add_argument('--version', action='version', version='%(prog)s v' + version_nb, help=argparse.SUPPRESS)
@@ -64,8 +235,20 @@ parser.add_argument('-h','--help', action='help', help=argparse.SUPPRESS)
 #=========================================================================================
 
 args = parser.parse_args()
+args.file_list = args.file_list[0]
 args.output_file = args.output_file[0]
 args.comments = args.comments[0].split(',')
+args.layouts = args.layouts[0]
+args.threads = args.threads[0]
+args.prefetch = args.prefetch[0]
+args.index = args.index[0]
+args.trim = args.trim[0]
+args.cache_dir = os.path.expanduser(args.cache_dir[0])
+args.cache_size = args.cache_size[0]
+args.outlier = args.outlier[0]
+args.frame_batch = args.frame_batch[0]
+args.progress_interval = args.progress_interval[0]
+args.checkpoint = args.checkpoint[0]
 
 #=========================================================================================
 # import modules (doing it now otherwise might crash before we can display the help menu!)
@@ -84,131 +267,482 @@ except:
 	print "Error: you need to install the scipy module."
 	sys.exit(1)
 
+#code shared by the xvg_average_op scripts
+try:
+	import xvg_average_op_common as common
+except ImportError:
+	print "Error: xvg_average_op_common.py should be in the same directory as " + str(parser.prog) + ".py."
+	sys.exit(1)
+
+#storage type of the data read in (sums are always accumulated in float64)
+if args.precision == "32":
+	data_dtype = np.float32
+else:
+	data_dtype = np.float64
+
 #=======================================================================
 # sanity check
 #=======================================================================
 
-if len(args.xvgfilenames) == 1:
+if args.file_list != "none":
+	if not os.path.isfile(args.file_list):
+		print "Error: file " + str(args.file_list) + " not found."
+		sys.exit(1)
+	with open(args.file_list) as f:
+		args.xvgfilenames += [line.strip() for line in f if line.strip() != ""]
+
+if len(args.xvgfilenames) == 0:
+	print "Error: no data file specified (use -f or --file_list)."
+	sys.exit(1)
+
+if len(args.xvgfilenames) == 1 and not args.partial and not args.merge:
 	print "Error: only 1 data file specified."
 	sys.exit(1)
+
+if args.partial and args.merge:
+	print "Error: --partial and --merge can't be used together."
+	sys.exit(1)
+
+if (args.partial or args.merge) and args.estimator != "mean":
+	print "Error: only the mean estimator can be used with --partial or --merge."
+	sys.exit(1)
+
+if args.sparse and (args.estimator != "mean" or args.diagnostics):
+	print "Error: --sparse can only be used with the mean estimator and without --diagnostics."
+	sys.exit(1)
+
+if args.threads < 1 or args.prefetch < 1:
+	print "Error: --threads and --prefetch should be at least 1."
+	sys.exit(1)
+
+if args.partial and (args.coverage or args.diagnostics or args.summary):
+	print "Error: --coverage, --diagnostics and --summary can't be used with --partial."
+	sys.exit(1)
+
+if args.merge and args.diagnostics:
+	print "Error: --diagnostics can't be used with --merge (the data of each file isn't kept in partial results)."
+	sys.exit(1)
+
+if args.frames and (args.partial or args.merge or args.coverage or args.diagnostics or args.summary):
+	print "Error: --partial, --merge, --coverage, --diagnostics and --summary can't be used with --frames."
+	sys.exit(1)
+
+if args.checkpoint < 0:
+	print "Error: --checkpoint should be 0 or more."
+	sys.exit(1)
+
+if (args.checkpoint > 0 or args.resume) and (args.merge or args.frames):
+	print "Error: --checkpoint and --resume can't be used with --merge or --frames."
+	sys.exit(1)
+
+if args.frame_batch < 1:
+	print "Error: --frame_batch should be at least 1."
+	sys.exit(1)
+
+if args.cache_size < 1:
+	print "Error: --cache_size should be at least 1."
+	sys.exit(1)
+
+if args.trim < 0 or args.trim >= 0.5:
+	print "Error: --trim should be between 0 and 0.5 (excluded)."
+	sys.exit(1)
+
+#the files are read in the same order whatever their order on the command line (the sums
+#don't depend on it, but the list of files does)
+args.xvgfilenames = sorted(args.xvgfilenames)
+
+#the data of each file is only kept if needed
+store_data = args.estimator != "mean" or args.diagnostics
 	
 for f in args.xvgfilenames:
 	if not os.path.isfile(f):
 		print "Error: file " + str(f) + " not found."
 		sys.exit(1)
 
+#=======================================================================
+# column layouts
+#=======================================================================
+
+#series read in the input files
+layout_series = ["upper avg", "upper std", "lower avg", "lower std"]
+
+#column of each series in the input files for each membrane: the layouts shipped in
+#xvg_average_op_layouts.ini, then those of the --layouts file (same format)
+tmp_layouts_files = [common.layouts_file]
+if args.layouts != "none":
+	tmp_layouts_files.append(args.layouts)
+layouts = {}
+for tmp_file in tmp_layouts_files:
+	try:
+		common.read_layouts(tmp_file, layout_series, layouts)
+	except ValueError, e:
+		print "Error: " + str(e)
+		sys.exit(1)
+
+if args.membrane != "auto" and args.membrane not in layouts:
+	print "Error: membrane should be 'auto' or one of " + ", ".join(sorted(layouts)) + "."
+	sys.exit(1)
+
 ##########################################################################################
 # FUNCTIONS DEFINITIONS
 ##########################################################################################
 
+#=========================================================================================
+# checkpoints
+#=========================================================================================
+
+def checkpoint_chunk_file(k):
+	
+	#chunk files holding the data of the files read between two checkpoints
+	return os.getcwd() + '/' + str(args.output_file) + '.ckpt.' + str(k) + '.npz'
+
+def write_checkpoint(nb_done):
+	
+	#sums over the first nb_done files, their data (if kept) being written in chunk
+	#files, each holding the files read since the previous checkpoint, so that each file
+	#is only written once
+	if store_data and nb_done > checkpoint_chunks[-1]:
+		tmp_chunk = {}
+		tmp_chunk["upper_avg"] = data_op_upper_avg[:, checkpoint_chunks[-1] + 1:nb_done + 1]
+		tmp_chunk["upper_std"] = data_op_upper_std[:, checkpoint_chunks[-1]:nb_done]
+		tmp_chunk["lower_avg"] = data_op_lower_avg[:, checkpoint_chunks[-1] + 1:nb_done + 1]
+		tmp_chunk["lower_std"] = data_op_lower_std[:, checkpoint_chunks[-1]:nb_done]
+		common.write_npz(checkpoint_chunk_file(len(checkpoint_chunks) - 1), tmp_chunk)
+		checkpoint_chunks.append(nb_done)
+	tmp_checkpoint = {}
+	tmp_checkpoint["key"] = checkpoint_key
+	tmp_checkpoint["nb_done"] = nb_done
+	tmp_checkpoint["chunks"] = np.array(checkpoint_chunks, dtype = int)
+	tmp_checkpoint["distances"] = distances
+	tmp_checkpoint["weights"] = weights[:nb_done]
+	for series in moments:
+		for m in moments[series]:
+			tmp_checkpoint[series.replace(" ", "_") + "_" + m] = moments[series][m]
+	common.write_npz(checkpoint_file, tmp_checkpoint)
+	
+	return
+
+def read_checkpoint():
+	
+	global distances
+	global nb_rows
+	global first_file
+	global checkpoint_chunks
+	
+	#checkpoint of a previous run (None if there's none), the nb of rows and weights of
+	#the files it holds being known from it
+	if not os.path.isfile(checkpoint_file):
+		print "\nWarning: no checkpoint found (" + str(checkpoint_file) + "), starting from the first file."
+		return None
+	tmp_checkpoint = np.load(checkpoint_file)
+	if str(tmp_checkpoint["key"]) != checkpoint_key:
+		print "\nError: the checkpoint " + str(checkpoint_file) + " was written for different files, options or layouts, or by another version of the script (remove it to start from the first file)."
+		sys.exit(1)
+	nb_done = int(tmp_checkpoint["nb_done"])
+	distances = tmp_checkpoint["distances"]
+	if nb_rows is not None and len(distances) != nb_rows:
+		print "\nError: the checkpoint " + str(checkpoint_file) + " has " + str(len(distances)) + " data rows, whereas file " + str(first_file) + " has " + str(nb_rows) + " data rows."
+		sys.exit(1)
+	nb_rows = len(distances)
+	first_file = checkpoint_file
+	weights[:nb_done] = tmp_checkpoint["weights"]
+	checkpoint_chunks = list(tmp_checkpoint["chunks"])
+	for k in range(0, len(checkpoint_chunks) - 1):
+		if not os.path.isfile(checkpoint_chunk_file(k)):
+			print "\nError: the chunk file " + str(checkpoint_chunk_file(k)) + " of the checkpoint is missing (remove " + str(checkpoint_file) + " to start from the first file)."
+			sys.exit(1)
+	
+	return tmp_checkpoint
+
+def restore_checkpoint(tmp_checkpoint):
+	
+	#sums (and data, if kept) of the files held by the checkpoint (returns their nb)
+	nb_done = int(tmp_checkpoint["nb_done"])
+	for series in moments:
+		for m in moments[series]:
+			moments[series][m] = np.copy(tmp_checkpoint[series.replace(" ", "_") + "_" + m])
+	if store_data:
+		for k in range(0, len(checkpoint_chunks) - 1):
+			tmp_chunk = np.load(checkpoint_chunk_file(k))
+			tmp_start = checkpoint_chunks[k]
+			tmp_stop = checkpoint_chunks[k + 1]
+			data_op_upper_avg[:, tmp_start + 1:tmp_stop + 1] = tmp_chunk["upper_avg"]
+			data_op_upper_std[:, tmp_start:tmp_stop] = tmp_chunk["upper_std"]
+			data_op_lower_avg[:, tmp_start + 1:tmp_stop + 1] = tmp_chunk["lower_avg"]
+			data_op_lower_std[:, tmp_start:tmp_stop] = tmp_chunk["lower_std"]
+	
+	return nb_done
+
+def remove_checkpoint():
+	
+	#checkpoint and chunk files (including that of a run stopped while writing one)
+	for tmp_file in [checkpoint_file] + [checkpoint_chunk_file(k) for k in range(0, len(checkpoint_chunks))]:
+		if os.path.isfile(tmp_file):
+			os.remove(tmp_file)
+	
+	return
+
 #=========================================================================================
 # data loading
 #=========================================================================================
 
-def load_xvg():															#DONE
+def index_xvg():
+	
+	global xvg_index
+	global nb_frames
+	global frame_rows
+	
+	#check that each file has the same number of data rows and columns (and frames)
+	xvg_index = common.index_xvg(args)
+	for f_index in range(0,len(args.xvgfilenames)):
+		add_entry(f_index, xvg_index[f_index])
+	if args.frames:
+		nb_frames, frame_rows = common.index_frames(args, xvg_index)
+	
+	return
+
+def add_entry(f_index, tmp_entry):
 	
 	global nb_rows
 	global nb_cols
+	global first_file
+	global usecols
+	nb_rows, nb_cols, first_file, usecols = common.add_entry(args, args.xvgfilenames[f_index], tmp_entry, [nb_rows, nb_cols, first_file, usecols], layouts, layout_series)
+	weights[f_index] = tmp_entry["weight"]
+	
+	return
+
+def allocate_data():
+	
+	global moments
+	global data_op_upper_avg
+	global data_op_upper_std
+	global data_op_lower_avg
+	global data_op_lower_std
+	
+	moments = {}
+	for series in ["upper avg", "upper std", "lower avg", "lower std"]:
+		moments[series] = common.moments_init(nb_rows)
+	
+	#the data itself is only needed by the robust estimators and the diagnostics
+	if store_data:
+		data_op_upper_avg = np.zeros((nb_rows, len(args.xvgfilenames) + 1), dtype = data_dtype)			#distance, avg op upper for each file
+		data_op_upper_std = np.zeros((nb_rows, len(args.xvgfilenames)), dtype = data_dtype)				#std op upper for each file
+		data_op_lower_avg = np.zeros((nb_rows, len(args.xvgfilenames) + 1), dtype = data_dtype)			#distance, avg op upper for each file
+		data_op_lower_std = np.zeros((nb_rows, len(args.xvgfilenames)), dtype = data_dtype)				#std op upper for each file
+	
+	return
+
+def load_xvg(tmp_frames = None):										#DONE
+	
 	global weights
+	global files_remaining
+	global distances
 	global data_op_upper_avg
 	global data_op_upper_std
 	global data_op_lower_avg
 	global data_op_lower_std
 
-	nb_rows = 0
-	nb_cols = 0
-	weights = np.ones(len(args.xvgfilenames))
-		
-	for f_index in range(0,len(args.xvgfilenames)):
-		#display progress
-		progress = '\r -reading file ' + str(f_index+1) + '/' + str(len(args.xvgfilenames)) + '                      '  
-		sys.stdout.flush()
-		sys.stdout.write(progress)
+	files_remaining = []
+	nb_done = 0
+	
+	#continue from the checkpoint of a previous run, the files it holds not being read
+	tmp_checkpoint = None
+	if args.resume:
+		tmp_checkpoint = read_checkpoint()
+	
+	#the size of the ensemble is known from the index or the checkpoint, if any, and
+	#otherwise from the first file read
+	if nb_rows is not None:
+		allocate_data()
+	if tmp_checkpoint is not None:
+		nb_done = restore_checkpoint(tmp_checkpoint)
+	
+	if tmp_frames is None:
+		xvg_contents = common.prefetch_xvg(args, functools.partial(common.read_xvg, args, xvg_index is not None), args.xvgfilenames[nb_done:], os.path.getsize)
+		tmp_progress = common.progress_init(args, "reading file", len(args.xvgfilenames), nb_done)
+	else:
+		#only the frames of the batch are read (nb_rows being their total nb of rows)
+		xvg_contents = common.prefetch_xvg(args, common.read_block, [[args.xvgfilenames[f_index]] + xvg_index[f_index]["frames"][n][:2] for f_index in range(0,len(args.xvgfilenames)) for n in tmp_frames], lambda tmp_block: tmp_block[2])
+		tmp_progress = common.progress_init(args, "reading frames " + str(tmp_frames[0]+1) + "-" + str(tmp_frames[-1]+1) + "/" + str(nb_frames) + " of file", len(args.xvgfilenames))
+	
+	for f_index in range(nb_done,len(args.xvgfilenames)):
+		#stop if the run is interrupted, only keeping the files read
+		if common.cancel_requested and tmp_frames is None:
+			xvg_contents.close()
+			if f_index == nb_done:
+				print "\n\nInterrupted before any file was read."
+				sys.exit(1)
+			if args.checkpoint > 0:
+				write_checkpoint(f_index)
+			files_remaining = args.xvgfilenames[f_index:]
+			args.xvgfilenames = args.xvgfilenames[:f_index]
+			weights = weights[:f_index]
+			if store_data:
+				data_op_upper_avg = data_op_upper_avg[:, :f_index + 1]
+				data_op_upper_std = data_op_upper_std[:, :f_index]
+				data_op_lower_avg = data_op_lower_avg[:, :f_index + 1]
+				data_op_lower_std = data_op_lower_std[:, :f_index]
+			break
 		
-		#get file content
+		#get data (checking the file against the first one if it wasn't indexed beforehand)
 		filename = args.xvgfilenames[f_index]
-		with open(filename) as f:
-			lines = f.readlines()
-		
-		#determine legends and nb of lines to skip
-		tmp_nb_rows_to_skip = 0
-		for l_index in range(0,len(lines)):
-			line = lines[l_index]
-			if line[0] in args.comments:
-				tmp_nb_rows_to_skip += 1
-				if "weight" in line:
-					if "-> weight = " in line:
-						weights[f_index] = float(line.split("-> weight = ")[1])
-						if weights[f_index] < 0:
-							print "\nError: the weight in file " + str(filename) + " should be a positive number."
-							print " -> " + str(line)
-							sys.exit(1)
-					else:
-						print "\nWarning: keyword 'weight' found in the comments of file " + str(filename) + ", but weight not read in as the format '-> weight = ' wasn't found."
-		
-		#get data
-		tmp_data = np.loadtxt(filename, skiprows = tmp_nb_rows_to_skip)
-		
-		#check that each file has the same number of data rows
-		if f_index == 0:
-			nb_rows = np.shape(tmp_data)[0]
-			data_op_upper_avg = np.zeros((nb_rows, len(args.xvgfilenames) + 1))			#distance, avg op upper for each file
-			data_op_upper_std = np.zeros((nb_rows, len(args.xvgfilenames)))				#std op upper for each file
-			data_op_lower_avg = np.zeros((nb_rows, len(args.xvgfilenames) + 1))			#distance, avg op upper for each file
-			data_op_lower_std = np.zeros((nb_rows, len(args.xvgfilenames)))				#std op upper for each file
+		if tmp_frames is not None:
+			tmp_data = np.concatenate([common.parse_block(xvg_contents.next(), filename, frame_rows, nb_cols, usecols) for n in tmp_frames])
 		else:
-			if np.shape(tmp_data)[0] != nb_rows:
-				print "Error: file " + str(filename) + " has " + str(np.shape(tmp_data)[0]) + " data rows, whereas file " + str(args.xvgfilenames[0]) + " has " + str(nb_rows) + " data rows."
-				sys.exit(1)
-		#check that each file has the same number of columns
-		if f_index == 0:
-			nb_cols = np.shape(tmp_data)[1]
-		else:
-			if np.shape(tmp_data)[1] != nb_cols:
-				print "Error: file " + str(filename) + " has " + str(np.shape(tmp_data)[1]) + " data columns, whereas file " + str(args.xvgfilenames[0]) + " has " + str(nb_cols) + " data columns."
-				sys.exit(1)
+			content, tmp_entry = xvg_contents.next()
+			if tmp_entry is None:
+				tmp_entry = xvg_index[f_index]
+			else:
+				add_entry(f_index, tmp_entry)
+				if f_index == 0:
+					allocate_data()
+			if args.mmap:
+				tmp_data = common.mmap_xvg(content, filename, tmp_entry, usecols)
+			else:
+				tmp_data = np.loadtxt(content.splitlines(True), skiprows = tmp_entry["header"], usecols = usecols, ndmin = 2)
+		
+		#check that the file hasn't changed since it was indexed
+		if np.shape(tmp_data)[0] != nb_rows:
+			print "\nError: file " + str(filename) + " has " + str(np.shape(tmp_data)[0]) + " data rows, whereas " + str(nb_rows) + " were found when indexing it."
+			sys.exit(1)
 		#check that each file has the same first column
 		if f_index == 0:
-			data_op_upper_avg[:,0] = tmp_data[:,0]
-			data_op_lower_avg[:,0] = tmp_data[:,0]
+			distances = np.copy(tmp_data[:,0])
 		else:
-			if not np.array_equal(tmp_data[:,0],data_op_upper_avg[:,0]):
+			if not np.array_equal(tmp_data[:,0],distances):
 				print "\nError: the first column of file " + str(filename) + " is different than that of " + str(args.xvgfilenames[0]) + "."
 				sys.exit(1)
 		
+		#select data (the sums are updated with the values as read, which are only cast to
+		#the storage precision when they're stored)
+		tmp_upper_avg = tmp_data[:,1]
+		tmp_upper_std = tmp_data[:,2]
+		tmp_lower_avg = tmp_data[:,3]
+		tmp_lower_std = tmp_data[:,4]
+
+		#update the sums (only over the rows between the first and last values of each
+		#series with --sparse)
+		for series, tmp_series_data in [["upper avg", tmp_upper_avg], ["upper std", tmp_upper_std], ["lower avg", tmp_lower_avg], ["lower std", tmp_lower_std]]:
+			try:
+				if args.sparse:
+					tmp_start, tmp_stop = common.valid_range(~np.isnan(tmp_series_data))
+					common.moments_update(moments[series], tmp_series_data, weights[f_index], slice(tmp_start, tmp_stop))
+				else:
+					common.moments_update(moments[series], tmp_series_data, weights[f_index])
+			except ValueError, e:
+				print "\nError: the '" + str(series) + "' of file " + str(filename) + " can't be summed exactly: " + str(e)
+				sys.exit(1)
+		
 		#store data
-		if args.membrane == "AM_zCter":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,3]
-			data_op_upper_std[:, f_index] = tmp_data[:,6]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,13]
-			data_op_lower_std[:, f_index] = tmp_data[:,17]
-		elif args.membrane == "AM_zNter":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,15]
-			data_op_upper_std[:, f_index] = tmp_data[:,18]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,4]
-			data_op_lower_std[:, f_index] = tmp_data[:,8]
-		elif args.membrane == "SMa":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,16]
-			data_op_upper_std[:, f_index] = tmp_data[:,20]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,4]
-			data_op_lower_std[:, f_index] = tmp_data[:,8]
-		elif args.membrane == "SMz":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,12]
-			data_op_upper_std[:, f_index] = tmp_data[:,15]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,3]
-			data_op_lower_std[:, f_index] = tmp_data[:,6]
-		elif args.membrane == "POPC":
-			data_op_upper_avg[:, f_index + 1] = tmp_data[:,8]
-			data_op_upper_std[:, f_index] = tmp_data[:,10]
-			data_op_lower_avg[:, f_index + 1] = tmp_data[:,2]
-			data_op_lower_std[:, f_index] = tmp_data[:,4]
+		if store_data:
+			data_op_upper_avg[:, f_index + 1] = tmp_upper_avg
+			data_op_upper_std[:, f_index] = tmp_upper_std
+			data_op_lower_avg[:, f_index + 1] = tmp_lower_avg
+			data_op_lower_std[:, f_index] = tmp_lower_std
+		
+		if args.checkpoint > 0 and (f_index + 1) % args.checkpoint == 0 and f_index + 1 < len(args.xvgfilenames):
+			write_checkpoint(f_index + 1)
+		
+		if tmp_frames is None:
+			common.progress_update(tmp_progress, f_index + 1, tmp_entry["size"])
+		else:
+			common.progress_update(tmp_progress, f_index + 1, sum([xvg_index[f_index]["frames"][n][1] for n in tmp_frames]))
 
 	return
 
+def merge_stats():
+	
+	global nb_rows
+	global weights
+	global distances
+	global moments
+	
+	#merge the partial results in the order of their first file, whatever their order (the
+	#sums don't depend on it, but the list of files does)
+	tmp_partials = []
+	for filename in args.xvgfilenames:
+		tmp_partial = dict(np.load(filename))
+		if str(tmp_partial["variant"]) != "simple":
+			print "\nError: file " + str(filename) + " wasn't written by xvg_average_op_simple with --partial."
+			sys.exit(1)
+		if "upper_avg_s1" not in tmp_partial:
+			print "\nError: file " + str(filename) + " was written by a previous version of xvg_average_op_simple, whose partial results can't be merged exactly: run it again with --partial."
+			sys.exit(1)
+		if args.membrane != "auto" and list(tmp_partial["columns"]) != [0] + [layouts[args.membrane][series] for series in layout_series]:
+			print "\nError: file " + str(filename) + " was written for membrane " + str(tmp_partial["membrane"]) + ", whose columns are different than those of membrane " + str(args.membrane) + "."
+			sys.exit(1)
+		if len(tmp_partials) > 0 and list(tmp_partial["columns"]) != list(tmp_partials[0][2]["columns"]):
+			print "\nError: the columns used for file " + str(filename) + " are different than those used for file " + str(tmp_partials[0][1]) + "."
+			sys.exit(1)
+		tmp_partials.append([str(tmp_partial["filenames"][0]), filename, tmp_partial])
+	tmp_partials.sort()
+	
+	tmp_filenames = []
+	tmp_weights = []
+	tmp_progress = common.progress_init(args, "merging partial result", len(tmp_partials))
+	for p_index in range(0,len(tmp_partials)):
+		filename, tmp_partial = tmp_partials[p_index][1:]
+		if p_index == 0:
+			distances = tmp_partial["distances"]
+			nb_rows = len(distances)
+			moments = {}
+			for series in ["upper avg", "upper std", "lower avg", "lower std"]:
+				moments[series] = {}
+				for m in common.moments_keys:
+					moments[series][m] = np.copy(tmp_partial[series.replace(" ", "_") + "_" + m])
+		else:
+			if not np.array_equal(tmp_partial["distances"], distances):
+				print "\nError: the first column of the files of " + str(filename) + " is different than that of the files of " + str(tmp_partials[0][1]) + "."
+				sys.exit(1)
+			for series in moments:
+				tmp_moments_other = {}
+				for m in moments[series]:
+					tmp_moments_other[m] = tmp_partial[series.replace(" ", "_") + "_" + m]
+				common.moments_merge(moments[series], tmp_moments_other)
+		tmp_filenames += [str(f) for f in tmp_partial["filenames"]]
+		tmp_weights.append(tmp_partial["weights"])
+		common.progress_update(tmp_progress, p_index + 1, os.path.getsize(filename))
+	
+	#check that no file was used in several partial results
+	for f in tmp_filenames:
+		if tmp_filenames.count(f) > 1:
+			print "\nError: file " + str(f) + " was used in several partial results."
+			sys.exit(1)
+	
+	#the average is then calculated as if all the files had been specified
+	args.xvgfilenames = tmp_filenames
+	weights = np.concatenate(tmp_weights)
+	
+	return
+
 #=========================================================================================
 # core functions
 #=========================================================================================
 
+def calculate_stats():
+	
+	global stats
+	
+	#the sums of each series are all that's needed to merge partial results
+	stats = {}
+	for series in moments:
+		for m in moments[series]:
+			stats[series.replace(" ", "_") + "_" + m] = moments[series][m]
+	
+	return
+
+def moments_avg_std(tmp_moments, data = None):
+	
+	#weighted avg and std dev from the sums, or with a robust estimator of the avg from
+	#the data read in (the std then being that of the deviations from this estimator)
+	if data is None:
+		return common.moments_avg_std(tmp_moments)
+	tmp_avg = common.calculate_estimator(data, weights, args.estimator, args.trim)
+	tmp_m2 = np.nansum(weights * (data - tmp_avg[:,np.newaxis])**2, axis = 1)
+	
+	return tmp_avg, common.moments_std(tmp_moments, tmp_m2)
+
 def calculate_avg():													#DONE
 
 	global avg_op_upper_avg
@@ -234,118 +768,187 @@ def calculate_avg():													#DONE
 	std_op_lower_std = np.zeros((nb_rows, 1))
 
 	#distances
-	avg_op_upper_avg[:,0] = data_op_upper_avg[:,0]
-	avg_op_lower_avg[:,0] = data_op_lower_avg[:,0]
-
-	#remove nan values of the weights for average values
-	weights_upper_nan_avg = np.zeros((nb_rows, 1))	
-	weights_upper_nan_avg_sq = np.zeros((nb_rows, 1))	
-	nb_files_upper_avg = np.ones((nb_rows, 1)) * len(args.xvgfilenames)
-	tmp_weights_nan = np.zeros((nb_rows, len(args.xvgfilenames)))
-	for r in range(0, nb_rows):
-		tmp_weights_nan[r,:] = weights
-		for f_index in range(0, len(args.xvgfilenames)):
-			if np.isnan(data_op_upper_avg[r,f_index + 1]):
-				tmp_weights_nan[r,f_index] = 0
-				nb_files_upper_avg[r,0] -= 1
-	weights_upper_nan_avg[:,0] = np.nansum(tmp_weights_nan, axis = 1)
-	weights_upper_nan_avg_sq[:,0] = np.nansum(tmp_weights_nan**2, axis = 1)	
-	weights_upper_nan_avg[weights_upper_nan_avg == 0] = 1
-	
-	weights_lower_nan_avg = np.zeros((nb_rows, 1))	
-	weights_lower_nan_avg_sq = np.zeros((nb_rows, 1))	
-	nb_files_lower_avg = np.ones((nb_rows, 1)) * len(args.xvgfilenames)
-	tmp_weights_nan = np.zeros((nb_rows, len(args.xvgfilenames)))
-	for r in range(0, nb_rows):
-		tmp_weights_nan[r,:] = weights
-		for f_index in range(0, len(args.xvgfilenames)):
-			if np.isnan(data_op_lower_avg[r,f_index + 1]):
-				tmp_weights_nan[r,f_index] = 0
-				nb_files_lower_avg[r,0] -= 1
-	weights_lower_nan_avg[:,0] = np.nansum(tmp_weights_nan, axis = 1)
-	weights_lower_nan_avg_sq[:,0] = np.nansum(tmp_weights_nan**2, axis = 1)	
-	weights_lower_nan_avg[weights_lower_nan_avg == 0] = 1
-
-	#remove nan values of the weights for std dev values
-	weights_upper_nan_std = np.zeros((nb_rows, 1))	
-	weights_upper_nan_std_sq = np.zeros((nb_rows, 1))	
-	nb_files_upper_std = np.ones((nb_rows, 1)) * len(args.xvgfilenames)
-	tmp_weights_nan = np.zeros((nb_rows, len(args.xvgfilenames)))
-	for r in range(0, nb_rows):
-		tmp_weights_nan[r,:] = weights
-		for f_index in range(0, len(args.xvgfilenames)):
-			if np.isnan(data_op_upper_std[r,f_index]):
-				tmp_weights_nan[r,f_index] = 0
-				nb_files_upper_std[r,0] -= 1
-	weights_upper_nan_std[:,0] = np.nansum(tmp_weights_nan, axis = 1)
-	weights_upper_nan_std_sq[:,0] = np.nansum(tmp_weights_nan**2, axis = 1)	
-	weights_upper_nan_std[weights_upper_nan_std == 0] = 1
-
-	weights_lower_nan_std = np.zeros((nb_rows, 1))	
-	weights_lower_nan_std_sq = np.zeros((nb_rows, 1))	
-	nb_files_lower_std = np.ones((nb_rows, 1)) * len(args.xvgfilenames)
-	tmp_weights_nan = np.zeros((nb_rows, len(args.xvgfilenames)))
-	for r in range(0, nb_rows):
-		tmp_weights_nan[r,:] = weights
-		for f_index in range(0, len(args.xvgfilenames)):
-			if np.isnan(data_op_lower_std[r,f_index]):
-				tmp_weights_nan[r,f_index] = 0
-				nb_files_lower_std[r,0] -= 1
-	weights_lower_nan_std[:,0] = np.nansum(tmp_weights_nan, axis = 1)
-	weights_lower_nan_std_sq[:,0] = np.nansum(tmp_weights_nan**2, axis = 1)	
-	weights_lower_nan_std[weights_lower_nan_std == 0] = 1
-
-	#calculate weighted average taking into account "nan"
-	#----------------------------------------------------
-	avg_op_upper_avg[:,1] =  scipy.stats.nanmean(data_op_upper_avg[:,1:] * weights * nb_files_upper_avg / weights_upper_nan_avg, axis = 1)
-	avg_op_lower_avg[:,1] =  scipy.stats.nanmean(data_op_lower_avg[:,1:] * weights * nb_files_lower_avg / weights_lower_nan_avg, axis = 1)
-	avg_op_upper_std[:,0] =  scipy.stats.nanmean(data_op_upper_std * weights * nb_files_upper_std / weights_upper_nan_std, axis = 1)
-	avg_op_lower_std[:,0] =  scipy.stats.nanmean(data_op_lower_std * weights * nb_files_lower_std / weights_lower_nan_avg, axis = 1)
-
-	#calculate unbiased weighted std dev taking into account "nan"
-	#-------------------------------------------------------------
-	tmp_upper_avg = np.zeros((nb_rows, 1))
-	tmp_lower_avg = np.zeros((nb_rows, 1))
-	tmp_upper_std = np.zeros((nb_rows, 1))
-	tmp_lower_std = np.zeros((nb_rows, 1))
-	tmp_upper_avg[:,0] = np.nansum(weights * (data_op_upper_avg[:,1:] - avg_op_upper_avg[:,1:2])**2, axis = 1)
-	tmp_lower_avg[:,0] = np.nansum(weights * (data_op_lower_avg[:,1:] - avg_op_lower_avg[:,1:2])**2, axis = 1)
-	tmp_upper_std[:,0] = np.nansum(weights * (data_op_upper_std - avg_op_upper_std)**2, axis = 1)
-	tmp_lower_std[:,0] = np.nansum(weights * (data_op_lower_std - avg_op_lower_std)**2, axis = 1)
-
-	tmp_div_upper_avg = np.copy((weights_upper_nan_avg)**2 - weights_upper_nan_avg_sq)
-	tmp_div_upper_avg[tmp_div_upper_avg == 0] = 1
-	tmp_div_lower_avg = np.copy((weights_lower_nan_avg)**2 - weights_lower_nan_avg_sq)
-	tmp_div_lower_avg[tmp_div_lower_avg == 0] = 1
-
-	tmp_div_upper_std = np.copy((weights_upper_nan_std)**2 - weights_upper_nan_std_sq)
-	tmp_div_upper_std[tmp_div_upper_std == 0] = 1
-	tmp_div_lower_std = np.copy((weights_lower_nan_std)**2 - weights_lower_nan_std_sq)
-	tmp_div_lower_std[tmp_div_lower_std == 0] = 1
-
-	std_op_upper_avg = np.sqrt(weights_upper_nan_avg / tmp_div_upper_avg * tmp_upper_avg)
-	std_op_lower_avg = np.sqrt(weights_lower_nan_avg / tmp_div_lower_avg * tmp_lower_avg)
-	std_op_upper_std = np.sqrt(weights_upper_nan_std / tmp_div_upper_std * tmp_upper_std)
-	std_op_lower_std = np.sqrt(weights_lower_nan_std / tmp_div_lower_std * tmp_lower_std)
+	avg_op_upper_avg[:,0] = distances
+	avg_op_lower_avg[:,0] = distances
+
+	#calculate weighted average and unbiased weighted std dev taking into account "nan"
+	#----------------------------------------------------------------------------------
+	if args.estimator == "mean":
+		avg_op_upper_avg[:,1], std_op_upper_avg[:,0] = moments_avg_std(moments["upper avg"])
+		avg_op_lower_avg[:,1], std_op_lower_avg[:,0] = moments_avg_std(moments["lower avg"])
+		avg_op_upper_std[:,0], std_op_upper_std[:,0] = moments_avg_std(moments["upper std"])
+		avg_op_lower_std[:,0], std_op_lower_std[:,0] = moments_avg_std(moments["lower std"])
+	else:
+		avg_op_upper_avg[:,1], std_op_upper_avg[:,0] = moments_avg_std(moments["upper avg"], data_op_upper_avg[:,1:])
+		avg_op_lower_avg[:,1], std_op_lower_avg[:,0] = moments_avg_std(moments["lower avg"], data_op_lower_avg[:,1:])
+		avg_op_upper_std[:,0], std_op_upper_std[:,0] = moments_avg_std(moments["upper std"], data_op_upper_std)
+		avg_op_lower_std[:,0], std_op_lower_std[:,0] = moments_avg_std(moments["lower std"], data_op_lower_std)
 
 	return
 
+def calculate_diagnostics():
+	
+	global rms_upper
+	global rms_lower
+	global outliers
+	
+	#rms deviation of each file from the average
+	rms_upper = np.sqrt(scipy.stats.nanmean((data_op_upper_avg[:,1:] - avg_op_upper_avg[:,1:2])**2, axis = 0))
+	rms_lower = np.sqrt(scipy.stats.nanmean((data_op_lower_avg[:,1:] - avg_op_lower_avg[:,1:2])**2, axis = 0))
+	
+	#outliers: files whose rms deviation is too far above the median (robust z score)
+	outliers = np.zeros(len(args.xvgfilenames), dtype = bool)
+	for tmp_rms in [rms_upper, rms_lower]:
+		tmp_median = scipy.stats.nanmedian(tmp_rms)
+		tmp_mad = 1.4826 * scipy.stats.nanmedian(np.abs(tmp_rms - tmp_median))
+		with np.errstate(invalid = 'ignore'):
+			outliers |= tmp_rms > tmp_median + args.outlier * tmp_mad
+	
+	return
+
+def average_frames():
+	
+	global nb_rows
+	
+	#the rows of a batch of frames are averaged as those of a single file, each batch
+	#being written before the next one is read
+	for frame_start in range(0, nb_frames, args.frame_batch):
+		#stop between two batches if the run is interrupted
+		if common.cancel_requested:
+			print "\n\nInterrupted: only the first " + str(frame_start) + " frames were averaged (see file '" + args.output_file + ".xvg')."
+			sys.exit(1)
+		tmp_frames = range(frame_start, min(frame_start + args.frame_batch, nb_frames))
+		nb_rows = len(tmp_frames) * frame_rows
+		load_xvg(tmp_frames)
+		calculate_stats()
+		calculate_avg()
+		write_xvg(tmp_frames)
+	
+	return
+
 #=========================================================================================
 # outputs
 #=========================================================================================
 
-def write_xvg():														#DONE
+def write_coverage():
 
-	#open files
-	filename_xvg = os.getcwd() + '/' + str(args.output_file) + '.xvg'
+	#nb of files with data for each row
+	filename_xvg = os.getcwd() + '/' + str(args.output_file) + '_coverage.xvg'
 	output_xvg = open(filename_xvg, 'w')
+	output_xvg.write("# [coverage xvg - written by xvg_average_op_simple v" + str(version_nb) + "]\n")
+	output_xvg.write("@ title \"Nb of files with data\"\n")
+	output_xvg.write("@ xaxis label \"distance from cluster z axis (Angstrom)\"\n")
+	output_xvg.write("@ yaxis label \"nb of files\"\n")
+	output_xvg.write("@ autoscale ONREAD xaxes\n")
+	output_xvg.write("@ TYPE XY\n")
+	output_xvg.write("@ legend on\n")
+	output_xvg.write("@ legend length 2\n")
+	output_xvg.write("@ s0 legend \"upper\"\n")
+	output_xvg.write("@ s1 legend \"lower\"\n")
+	for r in range(0, nb_rows):
+		output_xvg.write(str(distances[r]) + "	" + str(int(moments["upper avg"]["n"][r])) + "	" + str(int(moments["lower avg"]["n"][r])) + "\n")
+	output_xvg.close()
+	
+	return
+
+def write_diagnostics():
+
+	filename_txt = os.getcwd() + '/' + str(args.output_file) + '_files.txt'
+	output_txt = open(filename_txt, 'w')
+	output_txt.write("# [per file diagnostics - written by xvg_average_op_simple v" + str(version_nb) + "]\n")
+	output_txt.write("# file	weight	upper rms deviation	lower rms deviation	outlier\n")
+	for f_index in range(0, len(args.xvgfilenames)):
+		output_txt.write(str(args.xvgfilenames[f_index]) + "	" + str(weights[f_index]) + "	" + "{:.6e}".format(rms_upper[f_index]) + "	" + "{:.6e}".format(rms_lower[f_index]) + "	" + str(int(outliers[f_index])) + "\n")
+	output_txt.close()
+	
+	return
+
+def write_summary():
+
+	tmp_summary = {}
+	tmp_summary["script"] = "xvg_average_op_simple v" + str(version_nb)
+	tmp_summary["output"] = os.getcwd() + '/' + str(args.output_file) + '.xvg'
+	tmp_summary["options"] = dict(vars(args))
+	tmp_summary["files"] = list(args.xvgfilenames)
+	tmp_summary["weights"] = list(weights)
+	tmp_summary["nb rows"] = nb_rows
+	tmp_summary["nb rows with data"] = {"upper": int(np.sum(moments["upper avg"]["n"] > 0)), "lower": int(np.sum(moments["lower avg"]["n"] > 0))}
+	if args.diagnostics:
+		tmp_summary["outliers"] = [args.xvgfilenames[f_index] for f_index in np.where(outliers)[0]]
+	tmp_summary["duration (s)"] = time.time() - time_start
+	with open(os.getcwd() + '/' + str(args.output_file) + '_summary.json', 'w') as f:
+		json.dump(tmp_summary, f, indent = 1, sort_keys = True)
+	
+	return
+
+def write_summary_cached(tmp_dir):
+	
+	#update the summary copied from the cache with what's specific to this run
+	tmp_filename = os.getcwd() + '/' + str(args.output_file) + '_summary.json'
+	with open(tmp_filename) as f:
+		tmp_summary = json.load(f)
+	tmp_summary["output"] = os.getcwd() + '/' + str(args.output_file) + '.xvg'
+	tmp_summary["options"] = dict(vars(args))
+	tmp_summary["cached"] = tmp_dir
+	tmp_summary["duration (s)"] = time.time() - time_start
+	with open(tmp_filename, 'w') as f:
+		json.dump(tmp_summary, f, indent = 1, sort_keys = True)
+	
+	return
+
+def write_interrupted():
+	
+	#average and sums over the files read, and list of the files left (as a --file_list)
+	args.output_file = str(args.output_file) + "_interrupted"
+	calculate_stats()
+	write_stats()
+	if not args.partial:
+		calculate_avg()
+		write_xvg()
+	with open(os.getcwd() + '/' + str(args.output_file) + '_remaining.txt', 'w') as f:
+		f.write("\n".join(files_remaining) + "\n")
+	
+	return
+
+def write_stats():
+
+	#sums over the files, along with what's needed to check and merge them
+	filename_npz = os.getcwd() + '/' + str(args.output_file) + '.npz'
+	np.savez(filename_npz, variant = "simple", membrane = args.membrane, columns = np.array(usecols), filenames = np.array(args.xvgfilenames), weights = weights, distances = distances, **stats)
+	
+	return
+
+def write_xvg(tmp_frames = None):										#DONE
+
+	#open files (the frames after the first batch are appended)
+	filename_xvg = os.getcwd() + '/' + str(args.output_file) + '.xvg'
+	if tmp_frames is not None and tmp_frames[0] > 0:
+		output_xvg = open(filename_xvg, 'a')
+	else:
+		output_xvg = open(filename_xvg, 'w')
+		write_xvg_header(output_xvg)
+	
+	#data
+	for r in range(0, nb_rows):
+		if tmp_frames is not None and r % frame_rows == 0:
+			output_xvg.write("# frame " + str(tmp_frames[r / frame_rows] + 1) + "\n")
+		results = str(avg_op_upper_avg[r,0])
+		results += "	" + "{:.6e}".format(avg_op_upper_avg[r,1]) + "	" + "{:.6e}".format(std_op_upper_avg[r,0]) + "	" + "{:.6e}".format(avg_op_lower_avg[r,1]) + "	" + "{:.6e}".format(std_op_lower_avg[r,0]) + "	" + "{:.6e}".format(avg_op_upper_std[r,0]) + "	" + "{:.6e}".format(std_op_upper_std[r,0]) + "	" + "{:.6e}".format(avg_op_lower_std[r,0]) + "	" + "{:.6e}".format(std_op_lower_std[r,0])
+		output_xvg.write(results + "\n")		
+	output_xvg.close()	
 	
+	return
+
+def write_xvg_header(output_xvg):
+
 	#general header
 	output_xvg.write("# [average xvg - written by xvg_average_op_simple v" + str(version_nb) + "]\n")
 	tmp_files = ""
 	for f in args.xvgfilenames:
 		tmp_files += "," + str(f)
 	output_xvg.write("# - files: " + str(tmp_files[1:]) + "\n")
+	if args.frames:
+		output_xvg.write("# - frames: " + str(nb_frames) + "\n")
 	if np.sum(weights) > len(args.xvgfilenames):
 		output_xvg.write("# -> weight = " + str(np.sum(weights)) + "\n")
 	
@@ -370,29 +973,115 @@ def write_xvg():														#DONE
 	output_xvg.write("@ s6 legend \"lower std (avg)\"\n")
 	output_xvg.write("@ s7 legend \"lower std (std)\"\n")
 	
-	#data
-	for r in range(0, nb_rows):
-		results = str(avg_op_upper_avg[r,0])
-		results += "	" + "{:.6e}".format(avg_op_upper_avg[r,1]) + "	" + "{:.6e}".format(std_op_upper_avg[r,0]) + "	" + "{:.6e}".format(avg_op_lower_avg[r,1]) + "	" + "{:.6e}".format(std_op_lower_avg[r,0]) + "	" + "{:.6e}".format(avg_op_upper_std[r,0]) + "	" + "{:.6e}".format(std_op_upper_std[r,0]) + "	" + "{:.6e}".format(avg_op_lower_std[r,0]) + "	" + "{:.6e}".format(std_op_lower_std[r,0])
-		output_xvg.write(results + "\n")		
-	output_xvg.close()	
-	
 	return
 
 ##########################################################################################
 # MAIN
 ##########################################################################################
 
-print "\nReading files..."
-load_xvg()
+time_start = time.time()
+
+#checkpoints of this run (only valid for the same files, options and layouts)
+checkpoint_file = os.getcwd() + '/' + str(args.output_file) + '.ckpt.npz'
+if args.checkpoint > 0 or args.resume:
+	checkpoint_key = common.cache_key(args, parser.prog, version_nb, __file__, layouts)
+
+#first file of each chunk file of the checkpoint (and nb of files they hold in all)
+checkpoint_chunks = [0]
+
+#stop cleanly on SIGINT and SIGTERM
+signal.signal(signal.SIGINT, common.request_cancel)
+signal.signal(signal.SIGTERM, common.request_cancel)
 
-print "\n\nWriting average file..."
-calculate_avg()
-write_xvg()
+#index of the files, built beforehand with --index and --frames (the frames of each file
+#being needed to read them), otherwise as each file is read
+xvg_index = None
+nb_rows = None
+nb_cols = None
+first_file = None
+usecols = None
+weights = np.ones(len(args.xvgfilenames))
+
+#look for the result of an identical previous run
+use_cache = not args.no_cache and not args.partial
+cached = False
+if use_cache:
+	cache_key = common.cache_key(args, parser.prog, version_nb, __file__, layouts)
+	cached = common.cache_fetch(args, cache_key)
+
+if cached:
+	if os.path.isfile(os.path.join(args.cache_dir, cache_key, "result_summary.json")):
+		write_summary_cached(os.path.join(args.cache_dir, cache_key))
+	print "\nResult found in cache: the outputs were copied from " + os.path.join(args.cache_dir, cache_key) + " (use --no-cache to calculate them again)."
+elif args.frames:
+	print "\nIndexing files..."
+	index_xvg()
+	
+	print "\n\nReading and averaging frames..."
+	average_frames()
+	if use_cache:
+		common.check_cancel("caching the result")
+		common.cache_store(args, cache_key, [".xvg"])
+else:
+	if args.merge:
+		print "\nReading partial results..."
+		merge_stats()
+	else:
+		if args.index != "none":
+			print "\nIndexing files..."
+			index_xvg()
+			print ""
+		
+		print "\nReading files..."
+		load_xvg()
+		if len(files_remaining) > 0:
+			print "\n\nInterrupted: writing the results of the " + str(len(args.xvgfilenames)) + " files read..."
+			write_interrupted()
+			print "\nCheck results in files '" + args.output_file + ".npz' and '" + args.output_file + "_remaining.txt' (files left)."
+			print ""
+			sys.exit(1)
+		common.check_cancel("calculating the sums")
+		calculate_stats()
+	
+	if args.partial:
+		common.check_cancel("writing the partial results")
+		print "\n\nWriting partial results..."
+		write_stats()
+	else:
+		common.check_cancel("writing the average file")
+		print "\n\nWriting average file..."
+		calculate_avg()
+		write_xvg()
+		output_suffixes = [".xvg"]
+		if args.coverage:
+			common.check_cancel("writing the coverage")
+			write_coverage()
+			output_suffixes.append("_coverage.xvg")
+		if args.diagnostics:
+			common.check_cancel("calculating the diagnostics")
+			calculate_diagnostics()
+			write_diagnostics()
+			output_suffixes.append("_files.txt")
+		if args.summary:
+			common.check_cancel("writing the summary")
+			write_summary()
+			output_suffixes.append("_summary.json")
+		if use_cache:
+			common.check_cancel("caching the result")
+			common.cache_store(args, cache_key, output_suffixes)
 
 #=========================================================================================
 # exit
 #=========================================================================================
-print "\nFinished successfully! Check result in file '" + args.output_file + ".xvg'."
+if args.checkpoint > 0 or args.resume:
+	remove_checkpoint()
+if common.cancel_requested:
+	print "\n\nInterrupted too late to stop the run: the outputs were all written."
+	print ""
+	sys.exit(1)
+if args.partial:
+	print "\nFinished successfully! Check result in file '" + args.output_file + ".npz'."
+else:
+	print "\nFinished successfully! Check result in file '" + args.output_file + ".xvg'."
 print ""
 sys.exit(0)